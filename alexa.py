@@ -3,20 +3,25 @@
 # For a complete discussion, see http://forum.kodi.tv/showthread.php?tid=254502
 
 import datetime
-import random
 import string
 import time
 import os
-import re
-import codecs
+import io
+import sys
 import logging
+import util
 import music
-from flask import Flask, json, render_template
+import kodiclient
+import samples
+import metrics
+import deadline
+import templates
+from flask import Flask, json
 from functools import wraps
 from flask_ask import Ask, session, question, statement, audio, request, context
 from shutil import copyfile
 
-from kodi_voice import KodiConfigParser, Kodi
+from kodi_voice import KodiConfigParser
 
 
 app = Flask(__name__)
@@ -41,32 +46,109 @@ SKILL_ID = config.get('alexa', 'skill_id')
 if SKILL_ID and SKILL_ID != 'None' and not os.getenv('MEDIA_CENTER_SKILL_ID'):
   app.config['ASK_APPLICATION_ID'] = SKILL_ID
 
-LANGUAGE = config.get('global', 'language')
-if LANGUAGE == 'de':
-  TEMPLATE_FILE = "templates.de.yaml"
-elif LANGUAGE == 'it':
-  TEMPLATE_FILE = "templates.it.yaml"
-else:
-  LANGUAGE = 'en'
-  TEMPLATE_FILE = "templates.en.yaml"
+# Responses are in the language of the request's locale, or this one if
+# there are no templates for it
+LANGUAGE = templates.language_for_locale(config.get('global', 'language'), 'en')
+
+# Lambda starts a process for each burst of requests, so there templates and
+# help samples are prepared for each language the first time it's needed
+ON_LAMBDA = bool(os.getenv('AWS_LAMBDA_FUNCTION_NAME'))
 
 # According to this: https://alexatutorial.com/flask-ask/configuration.html
 # Timestamp based verification shouldn't be used in production. Use at own risk
 # app.config['ASK_VERIFY_TIMESTAMP_DEBUG'] = True
 
-# Needs to be instanced after app is configured
-ask = Ask(app, "/", None, path=TEMPLATE_FILE)
+# Needs to be instanced after app is configured.  No template path is
+# given, so flask-ask doesn't parse the templates; every language's templates
+# are served by templates.CatalogLoader instead.
+ask = Ask(app, "/", None, path='')
+app.jinja_loader = templates.CatalogLoader(templates.template_files(app.root_path))
+catalogs = templates.Catalogs(app.jinja_env)
+
+# Compile the templates and parse the help samples now rather than on the
+# first request, once for all the workers when gunicorn preloads the app
+if ON_LAMBDA:
+  samples.load(LANGUAGE)
+else:
+  catalogs.compile_all()
+  for language in templates.LANGUAGES:
+    samples.load(language)
+
+metrics.setup(app, config)
 
 
-# Direct lambda handler
+# Direct lambda handler.  Hands the event straight to the app rather than
+# going through flask-ask's run_aws_lambda, which copies the whole process
+# environment into every request and can't build the request body on
+# Python 2.
 def lambda_handler(event, _context):
-  return ask.run_aws_lambda(event)
+  # Only AWS can invoke the function
+  app.config['ASK_VERIFY_REQUESTS'] = False
+
+  body = json.dumps(event)
+  environ = {
+    'REQUEST_METHOD': 'POST',
+    'PATH_INFO': '/',
+    'SERVER_NAME': 'AWS-Lambda',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.0',
+    'CONTENT_TYPE': 'application/json',
+    'CONTENT_LENGTH': str(len(body)),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': 'http',
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+  }
+
+  status = []
+  def start_response(response_status, response_headers, exc_info=None):
+    status[:] = [response_status]
+
+  result = app(environ, start_response)
+  try:
+    output = b''.join(result)
+  finally:
+    if hasattr(result, 'close'):
+      result.close()
+
+  if not status or not status[0].startswith('2'):
+    raise AssertionError('Non-2xx from app: %s, body=%s' % (status, output))
+  return json.loads(output)
+
+# The language of the request being handled
+def request_language():
+  try:
+    return templates.language_for_locale(request.get('locale'), LANGUAGE)
+  except:
+    return LANGUAGE
+
+# Renders a response template in the language of the request
+def render_template(name, **context):
+  return catalogs.render(request_language(), name, **context)
+
+# Queues are kept per device (and optionally per user).  The web simulator
+# doesn't send a context object.
+def get_user_id():
+  try:
+    return context.System.user.userId
+  except:
+    return None
+
+# library, and search with it, are only imported by the intents that look
+# things up, so this is only called once an intent has raised something
+def library_unavailable():
+  import library
+  return library.LibraryUnavailable
+
 
 # Decorator to check your config for basic info and if your account is linked (when using the hosted skill)
 def preflight_check(f):
   @wraps(f)
   def decorated_function(*args, **kwargs):
-    kodi = Kodi(config, context)
+    kodi = kodiclient.get_kodi(config, context)
 
     if kodi.config_error:
       response_text = render_template('config_missing').encode('utf-8')
@@ -86,7 +168,21 @@ def preflight_check(f):
       kwargs.update({key: value.get('value')})
     kwargs.update({'kodi': kodi})
 
-    return f(*args, **kwargs)
+    # Kodi calls made by the intent give up when the budget runs out, and
+    # the user hears that Kodi is slow instead of nothing at all
+    with deadline.Budget(util.get_float_option(kodi, 'response_budget', deadline.DEFAULT_BUDGET)):
+      try:
+        return f(*args, **kwargs)
+      except deadline.DeadlineExceeded:
+        log.warning('Ran out of time in %s', f.__name__)
+        if metrics.enabled:
+          metrics.deadlines_exceeded.inc((metrics.request_name(request),))
+        response_text = render_template('kodi_too_slow').encode("utf-8")
+        return statement(response_text)
+      except library_unavailable() as e:
+        log.warning('Unable to load %s from Kodi in %s', e, f.__name__)
+        response_text = render_template('kodi_unavailable').encode("utf-8")
+        return statement(response_text)
   return decorated_function
 
 
@@ -96,35 +192,27 @@ def preflight_check(f):
 @ask.intent('StreamArtist')
 @preflight_check
 def alexa_stream_artist(kodi, Artist):
+  import library
+
   heard_artist = str(Artist).lower().translate(None, string.punctuation)
 
   card_title = render_template('stream_artist', heard_artist=heard_artist).encode("utf-8")
   log.info(card_title)
 
-  artists = kodi.GetMusicArtists()
-  if 'result' in artists and 'artists' in artists['result']:
-    artists_list = artists['result']['artists']
-    located = kodi.matchHeard(heard_artist, artists_list, 'artist')
-
-    if len(located):
-      located = located[0]
-      songs_result = kodi.GetArtistSongsPath(located['artistid'])
-      songs = songs_result['result']['songs']
-
-      songs_array = []
+  music_library = library.Library(kodi, request_language())
+  located = music_library.find_artist(heard_artist)
 
-      for song in songs:
-        songs_array.append(kodi.PrepareDownload(song['file']))
+  if len(located):
+    located = located[0]
+    source = {'type': 'artist', 'id': located['artistid']}
+    songs_array = music.fetch_source_files(kodi, source)
 
-      if len(songs_array) > 0:
-        random.shuffle(songs_array)
-        playlist_queue = music.MusicPlayer(kodi, songs_array)
+    if len(songs_array) > 0:
+      playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), source=source, shuffle=True)
 
-        response_text = render_template('streaming', heard_name=heard_artist).encode("utf-8")
-        audio('').clear_queue(stop=True)
-        return audio(response_text).play(songs_array[0])
-      else:
-        response_text = render_template('could_not_find', heard_name=heard_artist).encode("utf-8")
+      response_text = render_template('streaming', heard_name=heard_artist).encode("utf-8")
+      audio('').clear_queue(stop=True)
+      return audio(response_text).play(playlist_queue.current_item)
     else:
       response_text = render_template('could_not_find', heard_name=heard_artist).encode("utf-8")
   else:
@@ -137,45 +225,34 @@ def alexa_stream_artist(kodi, Artist):
 @ask.intent('StreamAlbum')
 @preflight_check
 def alexa_stream_album(kodi, Album, Artist):
+  import library
+
   heard_album = str(Album).lower().translate(None, string.punctuation)
   card_title = render_template('streaming_album_card').encode("utf-8")
   log.info(card_title)
 
+  music_library = library.Library(kodi, request_language())
+
   if Artist:
     heard_artist = str(Artist).lower().translate(None, string.punctuation)
-    artists = kodi.GetMusicArtists()
-    if 'result' in artists and 'artists' in artists['result']:
-      artists_list = artists['result']['artists']
-      located = kodi.matchHeard(heard_artist, artists_list, 'artist')
-
-      if len(located):
-        located = located[0]
-        albums = kodi.GetArtistAlbums(located['artistid'])
-        if 'result' in albums and 'albums' in albums['result']:
-          albums_list = albums['result']['albums']
-          album_located = kodi.matchHeard(heard_album, albums_list)
-
-          if len(album_located):
-            album_located = album_located[0]
-            songs_result = kodi.GetAlbumSongsPath(album_located['albumid'])
-            songs = songs_result['result']['songs']
-
-            songs_array = []
-
-            for song in songs:
-              songs_array.append(kodi.PrepareDownload(song['file']))
-
-            if len(songs_array) > 0:
-              random.shuffle(songs_array)
-              playlist_queue = music.MusicPlayer(kodi, songs_array)
-
-              response_text = render_template('streaming_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
-              audio('').clear_queue(stop=True)
-              return audio(response_text).play(songs_array[0])
-            else:
-              response_text = render_template('could_not_find_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
-          else:
-            response_text = render_template('could_not_find_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
+    music_library.prefetch('albums', 'songs')
+    located = music_library.find_artist(heard_artist)
+
+    if len(located):
+      located = located[0]
+      album_located = music_library.find_artist_album(located['artistid'], heard_album)
+
+      if len(album_located):
+        album_located = album_located[0]
+        source = {'type': 'album', 'id': album_located['albumid']}
+        songs_array = music.fetch_source_files(kodi, source)
+
+        if len(songs_array) > 0:
+          playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), source=source, shuffle=True)
+
+          response_text = render_template('streaming_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
+          audio('').clear_queue(stop=True)
+          return audio(response_text).play(playlist_queue.current_item)
         else:
           response_text = render_template('could_not_find_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
       else:
@@ -183,30 +260,19 @@ def alexa_stream_album(kodi, Album, Artist):
     else:
       response_text = render_template('could_not_find_album_artist', album_name=heard_album, artist=heard_artist).encode("utf-8")
   else:
-    albums = kodi.GetAlbums()
-    if 'result' in albums and 'albums' in albums['result']:
-      albums_list = albums['result']['albums']
-      album_located = kodi.matchHeard(heard_album, albums_list)
-
-      if len(album_located):
-        album_located = album_located[0]
-        songs_result = kodi.GetAlbumSongsPath(album_located['albumid'])
-        songs = songs_result['result']['songs']
+    album_located = music_library.find_album(heard_album)
 
-        songs_array = []
-
-        for song in songs:
-          songs_array.append(kodi.PrepareDownload(song['file']))
+    if len(album_located):
+      album_located = album_located[0]
+      source = {'type': 'album', 'id': album_located['albumid']}
+      songs_array = music.fetch_source_files(kodi, source)
 
-        if len(songs_array) > 0:
-          random.shuffle(songs_array)
-          playlist_queue = music.MusicPlayer(kodi, songs_array)
+      if len(songs_array) > 0:
+        playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), source=source, shuffle=True)
 
-          response_text = render_template('streaming_album', album_name=heard_album).encode("utf-8")
-          audio('').clear_queue(stop=True)
-          return audio(response_text).play(songs_array[0])
-        else:
-          response_text = render_template('could_not_find_album', album_name=heard_album).encode("utf-8")
+        response_text = render_template('streaming_album', album_name=heard_album).encode("utf-8")
+        audio('').clear_queue(stop=True)
+        return audio(response_text).play(playlist_queue.current_item)
       else:
         response_text = render_template('could_not_find_album', album_name=heard_album).encode("utf-8")
     else:
@@ -219,48 +285,36 @@ def alexa_stream_album(kodi, Album, Artist):
 @ask.intent('StreamSong')
 @preflight_check
 def alexa_stream_song(kodi, Song, Artist):
+  import library
+
   heard_song = str(Song).lower().translate(None, string.punctuation)
   card_title = render_template('streaming_song_card').encode("utf-8")
   log.info(card_title)
 
+  music_library = library.Library(kodi, request_language())
+
   if Artist:
     heard_artist = str(Artist).lower().translate(None, string.punctuation)
-    artists = kodi.GetMusicArtists()
-    if 'result' in artists and 'artists' in artists['result']:
-      artists_list = artists['result']['artists']
-      located = kodi.matchHeard(heard_artist, artists_list, 'artist')
-
-      if len(located):
-        located = located[0]
-        songs = kodi.GetArtistSongs(located['artistid'])
-        if 'result' in songs and 'songs' in songs['result']:
-          songs_list = songs['result']['songs']
-          song_located = kodi.matchHeard(heard_song, songs_list)
-
-          if len(song_located):
-            song_located = song_located[0]
-            songs_array = []
-            song = None
-
-            song_result = kodi.GetSongIdPath(song_located['songid'])
-
-            if 'songdetails' in song_result['result']:
-              song = song_result['result']['songdetails']['file']
-
-            if song:
-              songs_array.append(kodi.PrepareDownload(song))
-
-            if len(songs_array) > 0:
-              random.shuffle(songs_array)
-              playlist_queue = music.MusicPlayer(kodi, songs_array)
-
-              response_text = render_template('streaming_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
-              audio('').clear_queue(stop=True)
-              return audio(response_text).play(songs_array[0])
-            else:
-              response_text = render_template('could_not_find_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
-          else:
-            response_text = render_template('could_not_find_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
+    music_library.prefetch('albums', 'songs')
+    located = music_library.find_artist(heard_artist)
+
+    if len(located):
+      located = located[0]
+      song_located = music_library.find_artist_song(located['artistid'], heard_song)
+
+      if len(song_located):
+        song_located = song_located[0]
+        songs_array = []
+
+        if song_located.get('file'):
+          songs_array.append(song_located['file'])
+
+        if len(songs_array) > 0:
+          playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id())
+
+          response_text = render_template('streaming_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
+          audio('').clear_queue(stop=True)
+          return audio(response_text).play(playlist_queue.current_item)
         else:
           response_text = render_template('could_not_find_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
       else:
@@ -268,33 +322,21 @@ def alexa_stream_song(kodi, Song, Artist):
     else:
       response_text = render_template('could_not_find_song_artist', song_name=heard_song, artist=heard_artist).encode("utf-8")
   else:
-    songs = kodi.GetSongs()
-    if 'result' in songs and 'songs' in songs['result']:
-      songs_list = songs['result']['songs']
-      song_located = kodi.matchHeard(heard_song, songs_list)
-
-      if len(song_located):
-        song_located = song_located[0]
-        songs_array = []
-        song = None
+    song_located = music_library.find_song(heard_song)
 
-        song_result = kodi.GetSongIdPath(song_located['songid'])
-
-        if 'songdetails' in song_result['result']:
-          song = song_result['result']['songdetails']['file']
+    if len(song_located):
+      song_located = song_located[0]
+      songs_array = []
 
-        if song:
-          songs_array.append(kodi.PrepareDownload(song))
+      if song_located.get('file'):
+        songs_array.append(song_located['file'])
 
-        if len(songs_array) > 0:
-          random.shuffle(songs_array)
-          playlist_queue = music.MusicPlayer(kodi, songs_array)
+      if len(songs_array) > 0:
+        playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id())
 
-          response_text = render_template('streaming_song', song_name=heard_song).encode("utf-8")
-          audio('').clear_queue(stop=True)
-          return audio(response_text).play(songs_array[0])
-        else:
-          response_text = render_template('could_not_find_song', song_name=heard_song).encode("utf-8")
+        response_text = render_template('streaming_song', song_name=heard_song).encode("utf-8")
+        audio('').clear_queue(stop=True)
+        return audio(response_text).play(playlist_queue.current_item)
       else:
         response_text = render_template('could_not_find_song', song_name=heard_song).encode("utf-8")
     else:
@@ -307,6 +349,9 @@ def alexa_stream_song(kodi, Song, Artist):
 @ask.intent('StreamAlbumOrSong')
 @preflight_check
 def alexa_stream_album_or_song(kodi, Song, Album, Artist):
+  import search
+  import library
+
   if Song:
     heard_search = str(Song).lower().translate(None, string.punctuation)
   elif Album:
@@ -317,73 +362,52 @@ def alexa_stream_album_or_song(kodi, Song, Album, Artist):
   card_title = render_template('streaming_album_or_song').encode("utf-8")
   log.info(card_title)
 
-  artists = kodi.GetMusicArtists()
-  if 'result' in artists and 'artists' in artists['result']:
-    artists_list = artists['result']['artists']
-    located = kodi.matchHeard(heard_artist, artists_list, 'artist')
+  music_library = library.Library(kodi, request_language())
+  music_library.prefetch('albums', 'songs')
+  located = music_library.find_artist(heard_artist)
 
-    if len(located):
-      located = located[0]
-      albums = kodi.GetArtistAlbums(located['artistid'])
-      if 'result' in albums and 'albums' in albums['result']:
-        albums_list = albums['result']['albums']
-        album_located = kodi.matchHeard(heard_search, albums_list)
-
-        if len(album_located):
-          album_located = album_located[0]
-          songs_result = kodi.GetAlbumSongsPath(album_located['albumid'])
-          songs = songs_result['result']['songs']
-
-          songs_array = []
-
-          for song in songs:
-            songs_array.append(kodi.PrepareDownload(song['file']))
-
-          if len(songs_array) > 0:
-            random.shuffle(songs_array)
-            playlist_queue = music.MusicPlayer(kodi, songs_array)
-
-            response_text = render_template('streaming_album_artist', album_name=heard_search, artist=heard_artist).encode("utf-8")
-            audio('').clear_queue(stop=True)
-            return audio(response_text).play(songs_array[0])
-          else:
-            response_text = render_template('could_not_find_album_artist', album_name=heard_search, artist=heard_artist).encode("utf-8")
-        else:
-          songs = kodi.GetArtistSongs(located['artistid'])
-          if 'result' in songs and 'songs' in songs['result']:
-            songs_list = songs['result']['songs']
-            song_located = kodi.matchHeard(heard_search, songs_list)
-
-            if len(song_located):
-              song_located = song_located[0]
-              songs_array = []
-              song = None
-
-              song_result = kodi.GetSongIdPath(song_located['songid'])
-
-              if 'songdetails' in song_result['result']:
-                song = song_result['result']['songdetails']['file']
-
-              if song:
-                songs_array.append(kodi.PrepareDownload(song))
-
-              if len(songs_array) > 0:
-                random.shuffle(songs_array)
-                playlist_queue = music.MusicPlayer(kodi, songs_array)
-
-                response_text = render_template('streaming_song_artist', song_name=heard_search, artist=heard_artist).encode("utf-8")
-                audio('').clear_queue(stop=True)
-                return audio(response_text).play(songs_array[0])
-              else:
-                response_text = render_template('could_not_find_song_artist', song_name=heard_search, artist=heard_artist).encode("utf-8")
-            else:
-              response_text = render_template('could_not_find_song_artist', heard_name=heard_search, artist=heard_artist).encode("utf-8")
-          else:
-            response_text = render_template('could_not_find_song_artist', heard_name=heard_search, artist=heard_artist).encode("utf-8")
+  if len(located):
+    located = located[0]
+    album_located = music_library.find_artist_album(located['artistid'], heard_search)
+
+    # An album wins, unless it only roughly matched and a song's title is
+    # exactly what was heard
+    song_located = []
+    if not album_located or not search.same_title(album_located[0]['label'], heard_search):
+      song_located = music_library.find_artist_song(located['artistid'], heard_search)
+      if album_located and song_located and search.same_title(song_located[0]['label'], heard_search):
+        album_located = []
+
+    if len(album_located):
+      album_located = album_located[0]
+      source = {'type': 'album', 'id': album_located['albumid']}
+      songs_array = music.fetch_source_files(kodi, source)
+
+      if len(songs_array) > 0:
+        playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), source=source, shuffle=True)
+
+        response_text = render_template('streaming_album_artist', album_name=heard_search, artist=heard_artist).encode("utf-8")
+        audio('').clear_queue(stop=True)
+        return audio(response_text).play(playlist_queue.current_item)
+      else:
+        response_text = render_template('could_not_find_album_artist', album_name=heard_search, artist=heard_artist).encode("utf-8")
+    elif len(song_located):
+      song_located = song_located[0]
+      songs_array = []
+
+      if song_located.get('file'):
+        songs_array.append(song_located['file'])
+
+      if len(songs_array) > 0:
+        playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id())
+
+        response_text = render_template('streaming_song_artist', song_name=heard_search, artist=heard_artist).encode("utf-8")
+        audio('').clear_queue(stop=True)
+        return audio(response_text).play(playlist_queue.current_item)
       else:
-        response_text = render_template('could_not_find_song_artist', heard_name=heard_search, artist=heard_artist).encode("utf-8")
+        response_text = render_template('could_not_find_song_artist', song_name=heard_search, artist=heard_artist).encode("utf-8")
     else:
-      response_text = render_template('could_not_find_song_artist', heard_name=heard_search, artist=heard_artist).encode("utf-8")
+      response_text = render_template('could_not_find_song_artist', song_name=heard_search, artist=heard_artist).encode("utf-8")
   else:
     response_text = render_template('could_not_find', heard_name=heard_artist).encode("utf-8")
 
@@ -405,15 +429,14 @@ def alexa_stream_recently_added_songs(kodi):
     songs_array = []
 
     for song in songs:
-      songs_array.append(kodi.PrepareDownload(song['file']))
+      songs_array.append(song['file'])
 
     if len(songs_array) > 0:
-      random.shuffle(songs_array)
-      playlist_queue = music.MusicPlayer(kodi, songs_array)
+      playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), shuffle=True)
 
       response_text = render_template('streaming_recent_songs').encode("utf-8")
       audio('').clear_queue(stop=True)
-      return audio(response_text).play(songs_array[0])
+      return audio(response_text).play(playlist_queue.current_item)
 
   return statement(response_text).simple_card(card_title, response_text)
 
@@ -439,16 +462,14 @@ def alexa_stream_audio_playlist(kodi, AudioPlaylist, shuffle=False):
     songs_array = []
 
     for song in songs:
-      songs_array.append(kodi.PrepareDownload(song['file']))
+      songs_array.append(song['file'])
 
     if len(songs_array) > 0:
-      if shuffle:
-        random.shuffle(songs_array)
-      playlist_queue = music.MusicPlayer(kodi, songs_array)
+      playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), shuffle=shuffle)
 
-      response_text = render_template('playing_playlist', action=op, playlist_name=heard_search).encode("utf-8")
+      response_text = render_template('playing_playlist_audio', action=op, playlist_name=heard_search).encode("utf-8")
       audio('').clear_queue(stop=True)
-      return audio(response_text).play(songs_array[0])
+      return audio(response_text).play(playlist_queue.current_item)
     else:
       response_text = render_template('could_not_find_playlist', heard_name=heard_search).encode("utf-8")
   else:
@@ -466,21 +487,21 @@ def alexa_stream_party_play(kodi):
 
   response_text = render_template('streaming_party').encode("utf-8")
 
-  songs = kodi.GetSongsPath()
+  # Kodi picks a random batch; the queue tops itself up as it plays
+  songs = kodi.GetRandomSongsPath(music.party_batch_size(kodi))
 
   if 'result' in songs and 'songs' in songs['result']:
     songs_array = []
 
     for song in songs['result']['songs']:
-      songs_array.append(kodi.PrepareDownload(song['file']))
+      songs_array.append(song['file'])
 
     if len(songs_array) > 0:
-      random.shuffle(songs_array)
-      playlist_queue = music.MusicPlayer(kodi, songs_array)
+      playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id(), source={'type': 'party'})
 
       response_text = render_template('streaming_party').encode("utf-8")
       audio('').clear_queue(stop=True)
-      return audio(response_text).play(songs_array[0])
+      return audio(response_text).play(playlist_queue.current_item)
     else:
       response_text = render_template('error_parsing_results').encode("utf-8")
   else:
@@ -514,7 +535,7 @@ def alexa_stream_this(kodi):
     offset = int(datetime.timedelta(hours=x.tm_hour,
                                     minutes=x.tm_min, seconds=x.tm_sec).total_seconds()) * 1000
 
-    playlist_result = kodi.GetAudioPlaylistItems()
+    playlist_result = kodi.GetAudioPlaylistItemsPath()
 
     if 'items' in playlist_result['result']:
       playlist_items = playlist_result['result']['items']
@@ -526,20 +547,25 @@ def alexa_stream_this(kodi):
       final_playlist = playlist_items[current_index:]
 
     if len(final_playlist) > 0:
+      # Kodi normally includes the paths with the playlist items; look up any
+      # that are missing in one batch rather than one request per song.
+      missing = [song['id'] for song in final_playlist if not song.get('file')]
+      paths = kodi.GetSongsIdPath(missing) if missing else {}
+
       for song in final_playlist:
-        song_detail = kodi.GetSongIdPath(song['id'])
-        song_detail = song_detail['result']['songdetails']
-        songs_array.append(kodi.PrepareDownload(song_detail['file']))
+        path = song.get('file') or paths.get(song['id'])
+        if path:
+          songs_array.append(path)
 
     if len(songs_array) > 0:
-      playlist_queue = music.MusicPlayer(kodi, songs_array)
+      playlist_queue = music.MusicPlayer(kodi, songs_array, user_id=get_user_id())
 
       kodi.PlayerStop()
       kodi.ClearAudioPlaylist()
 
       response_text = render_template('transferring_stream').encode("utf-8")
       audio('').clear_queue(stop=True)
-      return audio(response_text).play(songs_array[0])
+      return audio(response_text).play(playlist_queue.current_item)
 
   else:
     response_text = render_template('nothing_currently_playing')
@@ -562,7 +588,7 @@ def stop():
 @ask.intent('AMAZON.NextIntent')
 @preflight_check
 def alexa_stream_skip(kodi):
-  playlist_queue = music.MusicPlayer(kodi)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.next_item:
     playlist_queue.skip_song()
@@ -576,7 +602,7 @@ def alexa_stream_skip(kodi):
 @ask.intent('AMAZON.PreviousIntent')
 @preflight_check
 def alexa_stream_prev(kodi):
-  playlist_queue = music.MusicPlayer(kodi)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.prev_item:
     playlist_queue.prev_song()
@@ -590,7 +616,7 @@ def alexa_stream_prev(kodi):
 @ask.intent('AMAZON.StartOverIntent')
 @preflight_check
 def alexa_stream_restart_track(kodi):
-  playlist_queue = music.MusicPlayer(kodi)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.current_item:
     return audio('').play(playlist_queue.current_item, offset=0)
@@ -603,7 +629,7 @@ def alexa_stream_restart_track(kodi):
 @ask.intent('AMAZON.ResumeIntent')
 @preflight_check
 def alexa_stream_resume(kodi):
-  playlist_queue = music.MusicPlayer(kodi)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.current_item:
     return audio('').play(playlist_queue.current_item, offset=playlist_queue.current_offset)
@@ -655,8 +681,8 @@ def alexa_cancel():
 # This allows for Next Intents and on_playback_finished requests to trigger the step
 @ask.on_playback_nearly_finished()
 def nearly_finished():
-  kodi = Kodi(config, context)
-  playlist_queue = music.MusicPlayer(kodi)
+  kodi = kodiclient.get_kodi(config, context)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.next_item:
     return audio().enqueue(playlist_queue.next_item)
@@ -664,8 +690,8 @@ def nearly_finished():
 
 @ask.on_playback_finished()
 def play_back_finished():
-  kodi = Kodi(config, context)
-  playlist_queue = music.MusicPlayer(kodi)
+  kodi = kodiclient.get_kodi(config, context)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   if playlist_queue.next_item:
     playlist_queue.skip_song()
@@ -678,47 +704,16 @@ def started(offset):
 
 @ask.on_playback_stopped()
 def stopped(offset):
-  kodi = Kodi(config, context)
-  playlist_queue = music.MusicPlayer(kodi)
+  kodi = kodiclient.get_kodi(config, context)
+  playlist_queue = music.MusicPlayer(kodi, user_id=get_user_id())
 
   playlist_queue.current_offset = offset
-  playlist_queue.save_to_mongo()
+  playlist_queue.save()
   log.info('Streaming stopped')
 
 
 def get_help_samples(limit=7):
-  # read example slot values from language-specific file.
-  sample_slotvals = {}
-  fn = os.path.join(os.path.dirname(__file__), 'sample_slotvals.%s.txt' % (LANGUAGE))
-  f = codecs.open(fn, 'rb', 'utf-8')
-  for line in f:
-    media_type, media_title = line.encode('utf-8').strip().split(' ', 1)
-    sample_slotvals[media_type] = media_title.strip()
-  f.close()
-
-  # don't suggest utterances for the following intents, because they depend on
-  # context to make any sense:
-  ignore_intents = []
-
-  # build complete list of possible utterances from file.
-  utterances = {}
-  fn = os.path.join(os.path.dirname(__file__), 'speech_assets/SampleUtterances.%s.txt' % (LANGUAGE))
-  f = codecs.open(fn, 'rb', 'utf-8')
-  for line in f:
-    intent, utterance = line.encode('utf-8').strip().split(' ', 1)
-    if intent in ignore_intents: continue
-    if intent not in utterances:
-      utterances[intent] = []
-    utterances[intent].append(utterance)
-  f.close()
-
-  # pick random utterances to return, up to the specified limit.
-  sample_utterances = {}
-  for k in random.sample(utterances.keys(), limit):
-    # substitute slot references for sample media titles.
-    sample_utterances[k] = re.sub(r'{(\w+)?}', lambda m: sample_slotvals.get(m.group(1), m.group(1)), random.choice(utterances[k])).decode('utf-8')
-
-  return sample_utterances
+  return samples.get_help_samples(request_language(), limit)
 
 
 @ask.intent('AMAZON.HelpIntent')
@@ -728,10 +723,10 @@ def prepare_help_message():
   response_text = render_template('help', example=sample_utterances.popitem()[1]).encode('utf-8')
   reprompt_text = render_template('help_short', example=sample_utterances.popitem()[1]).encode('utf-8')
   card_title = render_template('help_card').encode('utf-8')
-  samples = ''
+  examples = ''
   for sample in sample_utterances.values():
-    samples += '"%s"\n' % (sample)
-  card_text = render_template('help_text', examples=samples).encode('utf-8')
+    examples += '"%s"\n' % (sample)
+  card_text = render_template('help_text', examples=examples).encode('utf-8')
   log.info(card_title)
 
   if not 'queries_keep_open' in session.attributes:
@@ -0,0 +1,59 @@
+# Builds Alexa request bodies the way the Alexa service sends them to the
+# skill, for the benchmarks and load tests.
+import os
+import json
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def intent_slots():
+  schema = json.load(open(os.path.join(REPO_DIR, 'speech_assets', 'IntentSchema.json')))
+  return dict((i['intent'], [s['name'] for s in i.get('slots', [])]) for i in schema['intents'])
+
+SLOTS = intent_slots()
+
+
+def event(request_type, intent=None, slots=None, extra=None, device_id='benchmark-device', user_id='benchmark-user',
+          locale='en-US'):
+  request = {'type': request_type, 'requestId': 'benchmark', 'timestamp': '2018-01-01T00:00:00Z', 'locale': locale}
+  if intent:
+    # Alexa sends every slot in the schema, with a value only if it was heard
+    values = dict((name, {'name': name}) for name in SLOTS.get(intent, []))
+    for name, value in (slots or {}).items():
+      values[name] = {'name': name, 'value': value}
+    request['intent'] = {'name': intent, 'slots': values}
+  if extra:
+    request.update(extra)
+
+  user = {'userId': user_id}
+  return {
+    'version': '1.0',
+    'session': {'new': True, 'sessionId': 'benchmark', 'application': {'applicationId': 'benchmark'},
+                'attributes': {}, 'user': user},
+    'context': {'System': {'application': {'applicationId': 'benchmark'}, 'user': user,
+                           'device': {'deviceId': device_id, 'supportedInterfaces': {}}},
+                'AudioPlayer': {'playerActivity': 'IDLE'}},
+    'request': request,
+  }
+
+
+def playback(offset=0):
+  return {'token': 'benchmark', 'offsetInMilliseconds': offset}
+
+
+# Points a recorded request at another device and user
+def retarget(body, device_id, user_id):
+  body = json.loads(json.dumps(body))
+  system = body.setdefault('context', {}).setdefault('System', {})
+  system.setdefault('device', {})['deviceId'] = device_id
+  system.setdefault('user', {})['userId'] = user_id
+  body.setdefault('session', {}).setdefault('user', {})['userId'] = user_id
+  return body
+
+
+# Short name for reports: the intent name, or the request type for events
+def name(body):
+  request = body['request']
+  if request['type'] == 'IntentRequest':
+    return request['intent']['name']
+  return request['type']
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+# A stand-in for Kodi's JSON-RPC web server, serving a synthetic music library.
+# Only the methods this skill uses are implemented, and only as far as the
+# skill relies on them.
+#
+#   python benchmarks/fake_kodi.py [port] [songs] [latency ms]
+
+import sys
+import json
+import time
+import random
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import synthetic
+
+
+class FakeKodi:
+  def __init__(self, songs=1000, latency=0.0, seed=1):
+    self.artists, self.albums, self.songs = synthetic.library(songs, seed)
+    self.songs_by_id = dict((s['songid'], s) for s in self.songs)
+    self.latency = latency
+    self.calls = {}
+    self.lock = threading.Lock()
+    self.playlist = []
+    self.playing = None
+
+  def count(self, method):
+    with self.lock:
+      self.calls[method] = self.calls.get(method, 0) + 1
+
+  # Kodi always returns the id and label, plus any requested properties
+  def project(self, items, id_field, params):
+    fields = params.get('properties', [])
+    return [dict((k, v) for k, v in item.items() if k in fields or k in (id_field, 'label', 'artist')) for item in items]
+
+  def matches(self, item, f):
+    if not f:
+      return True
+    if 'and' in f:
+      return all(self.matches(item, x) for x in f['and'])
+    if 'or' in f:
+      return any(self.matches(item, x) for x in f['or'])
+    if 'artistid' in f:
+      return f['artistid'] in item.get('artistid', []) or f['artistid'] in item.get('albumartistid', [])
+    if 'albumid' in f:
+      return item.get('albumid') == f['albumid']
+    if f.get('field') == 'songid' or 'songid' in f:
+      value = f.get('songid', f.get('value'))
+      return str(item.get('songid')) == str(value)
+    return True
+
+  def page(self, items, params, key):
+    total = len(items)
+    sort = params.get('sort') or {}
+    limits = params.get('limits')
+    if sort.get('method') == 'random':
+      # Only shuffle as much as will be returned
+      count = min(total, limits.get('end', total)) if limits else total
+      items = random.sample(items, count)
+
+    if limits:
+      items = items[limits.get('start', 0):limits.get('end', total)]
+      return {key: items, 'limits': {'start': limits.get('start', 0), 'end': limits.get('start', 0) + len(items), 'total': total}}
+    return {key: items, 'limits': {'start': 0, 'end': total, 'total': total}}
+
+  def call(self, method, params):
+    self.count(method)
+
+    if method == 'AudioLibrary.GetArtists':
+      return self.page(self.artists, params, 'artists')
+    elif method == 'AudioLibrary.GetAlbums':
+      albums = self.albums
+      if params.get('filter'):
+        albums = [a for a in albums if self.matches(a, params['filter'])]
+      result = self.page(albums, params, 'albums')
+      result['albums'] = self.project(result['albums'], 'albumid', params)
+      return result
+    elif method == 'AudioLibrary.GetSongs':
+      songs = self.songs
+      if params.get('filter'):
+        songs = [s for s in songs if self.matches(s, params['filter'])]
+      result = self.page(songs, params, 'songs')
+      result['songs'] = self.project(result['songs'], 'songid', params)
+      return result
+    elif method == 'AudioLibrary.GetSongDetails':
+      song = self.songs_by_id[params['songid']]
+      return {'songdetails': self.project([song], 'songid', params)[0]}
+    elif method == 'AudioLibrary.GetRecentlyAddedSongs':
+      return {'songs': self.project(self.songs[-25:], 'songid', params)}
+    elif method == 'AudioLibrary.GetGenres':
+      return {'genres': [{'genreid': i, 'label': w.title()} for i, w in enumerate(synthetic.WORDS[:20])]}
+    elif method == 'Files.GetDirectory':
+      if params.get('directory') == 'special://musicplaylists':
+        return {'files': [{'file': 'special://musicplaylists/%s.xsp' % w, 'label': w.title(), 'filetype': 'file'} for w in synthetic.WORDS[:5]]}
+      return {'files': [{'file': s['file'], 'label': s['label'], 'filetype': 'file'} for s in self.songs[:50]]}
+    elif method == 'Player.GetActivePlayers':
+      if self.playing:
+        return [{'playerid': 0, 'type': 'audio'}]
+      return []
+    elif method == 'Player.GetItem':
+      return {'item': {'id': self.playing, 'type': 'song', 'label': self.songs_by_id[self.playing]['label']}}
+    elif method == 'Player.GetProperties':
+      return {'time': {'hours': 0, 'minutes': 1, 'seconds': 5, 'milliseconds': 0},
+              'totaltime': {'hours': 0, 'minutes': 3, 'seconds': 30, 'milliseconds': 0},
+              'percentage': 30.0, 'speed': 1, 'shuffled': False, 'repeat': 'off'}
+    elif method == 'Playlist.GetItems':
+      items = [dict(self.songs_by_id[i], id=i, type='song') for i in self.playlist]
+      return {'items': self.project(items, 'id', dict(params, properties=params.get('properties', []) + ['type']))}
+    elif method in ('Player.Stop', 'Playlist.Clear'):
+      self.playing = None
+      self.playlist = []
+      return 'OK'
+    return 'OK'
+
+  # Make it look like Kodi is playing a playlist of the given length
+  def play_playlist(self, length):
+    self.playlist = [s['songid'] for s in self.songs[:length]]
+    self.playing = self.playlist[0]
+
+  def handle(self, body):
+    if self.latency:
+      time.sleep(self.latency)
+
+    requests = body if isinstance(body, list) else [body]
+    responses = []
+    for request in requests:
+      try:
+        result = self.call(request['method'], request.get('params', {}))
+        responses.append({'id': request.get('id'), 'jsonrpc': '2.0', 'result': result})
+      except Exception as e:
+        responses.append({'id': request.get('id'), 'jsonrpc': '2.0', 'error': {'code': -32602, 'message': repr(e)}})
+
+    if isinstance(body, list):
+      return responses
+    return responses[0]
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one write, so keep-alive connections don't stall
+  # on delayed ACKs
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+    out = json.dumps(self.server.kodi.handle(body))
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(out)))
+    self.end_headers()
+    self.wfile.write(out)
+    self.wfile.flush()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  # Room for the many connections an asynchronous worker opens at once
+  request_queue_size = 128
+  connections = 0
+
+  def get_request(self):
+    self.connections += 1
+    return HTTPServer.get_request(self)
+
+
+# Starts the server on a background thread and returns it.  The FakeKodi
+# instance is available as server.kodi.
+def start(port=0, songs=1000, latency=0.0):
+  server = Server(('127.0.0.1', port), Handler)
+  server.kodi = FakeKodi(songs, latency)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  return server
+
+
+if __name__ == '__main__':
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+  songs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+  latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+
+  server = Server(('127.0.0.1', port), Handler)
+  server.kodi = FakeKodi(songs, latency)
+  print 'Fake Kodi with %d songs on port %d' % (songs, port)
+  server.serve_forever()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+# Measures how long the skill takes to start, the way a Lambda cold start
+# sees it: a fresh interpreter imports alexa.py and lambda_handler gets the
+# first request.
+# Prints the slowest imports in the same form as Python 3's -X importtime,
+# with the time spent in each module itself and including what it imported.
+#
+#   python benchmarks/importtime.py [number of modules to list] [runs]
+#
+# The import breakdown is taken from the first run; the totals are the
+# median over all runs, each in a new process.
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+# Full name of an imported module, which Python 2 lets packages import by a
+# name relative to themselves
+def module_name(name, globals, loaded):
+  if name in loaded:
+    return name
+  package = (globals or {}).get('__package__')
+  if not package and globals:
+    package = globals.get('__name__', '')
+    if '__path__' not in globals:
+      package = package.rpartition('.')[0]
+  if package and package + '.' + name in loaded:
+    return package + '.' + name
+  return name or package
+
+
+# Replaces __import__ with a version that records how long each module took
+# to load, counting only the first import of each module
+def install_timer(timings):
+  import __builtin__
+  original = __builtin__.__import__
+  stack = []
+
+  def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+      return original(name, globals, locals, fromlist, level)
+
+    before = set(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+      return original(name, globals, locals, fromlist, level)
+    finally:
+      total = time.time() - start
+      nested = stack.pop()
+      if stack:
+        stack[-1] += total
+      loaded = set(m for m in set(sys.modules) - before if sys.modules[m] is not None)
+      if loaded:
+        timings.append((module_name(name, globals, loaded), total - nested, total, len(stack)))
+
+  __builtin__.__import__ = timed_import
+
+
+# Runs in the child process: imports the skill and hands lambda_handler a
+# LaunchRequest, then a help request
+def measure():
+  timings = []
+  sys.path.insert(0, REPO_DIR)
+  sys.path.insert(0, BENCHMARKS_DIR)
+
+  start = time.time()
+  install_timer(timings)
+  import alexa
+  imported = time.time() - start
+
+  import events
+  alexa.app.config['ASK_APPLICATION_ID'] = None
+  start = time.time()
+  alexa.lambda_handler(events.event('LaunchRequest'), None)
+  first = time.time() - start
+  start = time.time()
+  alexa.lambda_handler(events.event('IntentRequest', 'AMAZON.HelpIntent'), None)
+  second = time.time() - start
+
+  print json.dumps({'import': imported, 'first_request': first, 'second_request': second,
+                    'modules': len(sys.modules), 'timings': timings})
+
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == '--child':
+    measure()
+    return 0
+
+  limit = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+  runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+  results = []
+  for i in range(runs):
+    # Run from the repo so the skill finds its templates and kodi.config, and
+    # tell it it's on Lambda so it starts the way it does there
+    env = dict(os.environ)
+    env.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'importtime')
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'], cwd=REPO_DIR,
+                                  stderr=open(os.devnull, 'w'), env=env)
+    results.append(json.loads(out.strip().splitlines()[-1]))
+
+  print 'import time: %8s %10s   module' % ('self us', 'cumul us')
+  slowest = sorted(results[0]['timings'], key=lambda t: -t[2])[:limit]
+  for name, own, total, depth in sorted(slowest, key=lambda t: results[0]['timings'].index(t)):
+    print 'import time: %8d %10d | %s%s' % (own * 1e6, total * 1e6, '  ' * depth, name)
+  print
+
+  def median(key):
+    values = sorted(r[key] for r in results)
+    return values[len(values) // 2]
+
+  print 'import alexa    %8.1fms (median of %d)' % (median('import') * 1000, runs)
+  print 'first request   %8.1fms' % (median('first_request') * 1000)
+  print 'second request  %8.1fms' % (median('second_request') * 1000)
+  print 'modules loaded  %8d' % (median('modules'))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
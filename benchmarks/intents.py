@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+# Drives every intent and AudioPlayer event in alexa.py against the fake Kodi
+# server, with the in-memory queue store standing in for Mongo, and reports
+# latency percentiles and memory use per intent for each library size.
+#
+#   python benchmarks/intents.py [sizes] [iterations] [kodi latency ms]
+#
+#   python benchmarks/intents.py 1000,10000,100000 50 0
+#
+# Requests go through the Flask app, the same way the hosted skill gets them.
+# Each library size runs in its own process so memory figures aren't mixed
+# up.  The [DEFAULT] section of kodi.config is overridden to point at the
+# fake server; nothing is sent to a real Kodi box.
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import events
+import synthetic
+import fake_kodi
+
+
+def percentile(timings, p):
+  timings = sorted(timings)
+  return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))] * 1000
+
+
+# Current resident set size in KB
+def rss():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize() // 1024
+  except IOError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Driver:
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def send(self, event):
+    response = self.client.post('/', data=json.dumps(event), content_type='application/json')
+    # flask-ask answers 400 when a handler returns nothing, which the
+    # playback event handlers often do
+    if response.status_code >= 500:
+      raise Exception('%s returned %d' % (events.name(event), response.status_code))
+    return response.data
+
+
+# (name, function returning the event to send) for every handler in alexa.py
+def scenarios(server, rnd):
+  kodi = server.kodi
+  ev = events.event
+  playback = events.playback
+
+  def artist():
+    return synthetic.heard(rnd, rnd.choice(kodi.artists)['artist'])
+
+  def album():
+    return synthetic.heard(rnd, rnd.choice(kodi.albums)['label'])
+
+  def album_by_artist():
+    a = rnd.choice(kodi.albums)
+    name = [x['artist'] for x in kodi.artists if x['artistid'] == a['artistid'][0]][0]
+    return {'Album': synthetic.heard(rnd, a['label']), 'Artist': synthetic.heard(rnd, name)}
+
+  def song():
+    return synthetic.heard(rnd, rnd.choice(kodi.songs)['label'])
+
+  def song_by_artist():
+    s = rnd.choice(kodi.songs)
+    name = [x['artist'] for x in kodi.artists if x['artistid'] == s['artistid'][0]][0]
+    return {'Song': synthetic.heard(rnd, s['label']), 'Artist': synthetic.heard(rnd, name)}
+
+  def stream_this():
+    kodi.play_playlist(50)
+    return ev('IntentRequest', 'StreamThis')
+
+  return [
+    ('LaunchRequest', lambda: ev('LaunchRequest')),
+    ('StreamArtist', lambda: ev('IntentRequest', 'StreamArtist', {'Artist': artist()})),
+    ('StreamAlbum', lambda: ev('IntentRequest', 'StreamAlbum', {'Album': album()})),
+    ('StreamAlbum+Artist', lambda: ev('IntentRequest', 'StreamAlbum', album_by_artist())),
+    ('StreamSong', lambda: ev('IntentRequest', 'StreamSong', {'Song': song()})),
+    ('StreamSong+Artist', lambda: ev('IntentRequest', 'StreamSong', song_by_artist())),
+    ('StreamAlbumOrSong/album', lambda: ev('IntentRequest', 'StreamAlbumOrSong', album_by_artist())),
+    ('StreamAlbumOrSong/song', lambda: ev('IntentRequest', 'StreamAlbumOrSong', song_by_artist())),
+    ('StreamAudioPlaylistRecent', lambda: ev('IntentRequest', 'StreamAudioPlaylistRecent')),
+    ('StreamAudioPlaylist', lambda: ev('IntentRequest', 'StreamAudioPlaylist', {'AudioPlaylist': rnd.choice(synthetic.WORDS[:5])})),
+    ('StreamThis', stream_this),
+    ('StreamPartyMode', lambda: ev('IntentRequest', 'StreamPartyMode')),
+    ('PlaybackStarted', lambda: ev('AudioPlayer.PlaybackStarted', extra=playback())),
+    ('PlaybackNearlyFinished', lambda: ev('AudioPlayer.PlaybackNearlyFinished', extra=playback())),
+    ('PlaybackFinished', lambda: ev('AudioPlayer.PlaybackFinished', extra=playback())),
+    ('AMAZON.NextIntent', lambda: ev('IntentRequest', 'AMAZON.NextIntent')),
+    ('AMAZON.PreviousIntent', lambda: ev('IntentRequest', 'AMAZON.PreviousIntent')),
+    ('AMAZON.PauseIntent', lambda: ev('IntentRequest', 'AMAZON.PauseIntent')),
+    ('PlaybackStopped', lambda: ev('AudioPlayer.PlaybackStopped', extra=playback(rnd.randint(0, 200000)))),
+    ('AMAZON.ResumeIntent', lambda: ev('IntentRequest', 'AMAZON.ResumeIntent')),
+    ('AMAZON.StartOverIntent', lambda: ev('IntentRequest', 'AMAZON.StartOverIntent')),
+    ('AMAZON.StopIntent', lambda: ev('IntentRequest', 'AMAZON.StopIntent')),
+    ('AMAZON.CancelIntent', lambda: ev('IntentRequest', 'AMAZON.CancelIntent')),
+    ('AMAZON.HelpIntent', lambda: ev('IntentRequest', 'AMAZON.HelpIntent')),
+    ('SessionEndedRequest', lambda: ev('SessionEndedRequest', extra={'reason': 'USER_INITIATED'})),
+  ]
+
+
+def run(songs, iterations, latency):
+  rss_start = rss()
+  server = fake_kodi.start(0, songs, latency)
+  rss_library = rss()
+
+  import local_app
+  driver = Driver(local_app.configure(server.server_address[1], 'memory'))
+  # Wait for the library however long it takes instead of answering that
+  # Kodi is slow, so the first requests measure the fetch
+  local_app.alexa.config.set('DEFAULT', 'response_budget', '0')
+  rnd = random.Random(songs)
+  plan = scenarios(server, rnd)
+
+  # The first requests fetch and index the library
+  start = time.time()
+  before = rss()
+  for name in ('StreamArtist', 'StreamAlbum'):
+    driver.send(dict(plan)[name]())
+  first = time.time() - start
+  rss_snapshot = rss() - before
+
+  results = []
+  for name, make_event in plan:
+    timings = []
+    before = rss()
+    for i in range(iterations):
+      event = make_event()
+      start = time.time()
+      driver.send(event)
+      timings.append(time.time() - start)
+    results.append((name, timings, rss() - before))
+
+  print 'library of %d songs, %d requests per intent, kodi latency %dms' % (songs, iterations, latency * 1000)
+  print '  first requests (library fetch and index) %8.2fms, +%dKB' % (first * 1000, rss_snapshot)
+  print '  %-27s %9s %9s %9s %9s' % ('', 'p50 ms', 'p95 ms', 'p99 ms', 'rss +KB')
+  for name, timings, grown in results:
+    print '  %-27s %9.2f %9.2f %9.2f %9d' % (name, percentile(timings, 50), percentile(timings, 95),
+                                             percentile(timings, 99), grown)
+  print '  rss: %dKB at start, %dKB with fake library, %dKB at end, %dKB peak' % (
+    rss_start, rss_library, rss(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+  print
+
+  server.shutdown()
+
+
+def main():
+  sizes = [int(s) for s in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1000, 10000, 100000]
+  iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+  latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+
+  if len(sizes) == 1:
+    run(sizes[0], iterations, latency)
+    return 0
+
+  for size in sizes:
+    args = [sys.executable, os.path.abspath(__file__), str(size), str(iterations), str(latency * 1000)]
+    if subprocess.call(args) != 0:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# Compares building a new Kodi client per request (and a new HTTP connection
+# per JSON-RPC call) with the pooled clients from kodiclient.get_kodi(),
+# against a local fake Kodi.  Each simulated request makes the three calls
+# StreamAlbum used to make: artists -> artist's albums -> album songs.
+#
+#   python benchmarks/kodi_client.py [requests] [songs]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fake_kodi
+import kodiclient
+from kodi_voice import KodiConfigParser, Kodi
+
+
+def make_config(port):
+  config = KodiConfigParser(os.path.join(os.path.dirname(__file__), 'nonexistent.config'))
+  for option, value in (('scheme', 'http'), ('address', '127.0.0.1'), ('port', str(port)),
+                        ('subpath', ''), ('username', 'kodi'), ('password', 'kodi')):
+    config.set('DEFAULT', option, value)
+  config.set('global', 'loglevel', 'WARNING')
+  return config
+
+
+def percentile(timings, p):
+  timings = sorted(timings)
+  return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))] * 1000
+
+
+def run(make_kodi, count):
+  timings = []
+  for i in range(count):
+    start = time.time()
+    kodi = make_kodi()
+    kodi.GetMusicArtists()
+    kodi.GetArtistAlbums(1)
+    kodi.GetAlbumSongsPath(1)
+    timings.append(time.time() - start)
+  return timings
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  songs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+  server = fake_kodi.start(songs=songs)
+  config = make_config(server.server_address[1])
+
+  for name, make_kodi in (('new client per request', lambda: Kodi(config)),
+                          ('pooled client', lambda: kodiclient.get_kodi(config))):
+    connections = server.connections
+    timings = run(make_kodi, count)
+    print '%-24s p50 %6.2fms  p95 %6.2fms  p99 %6.2fms  connections opened %d' % (
+      name, percentile(timings, 50), percentile(timings, 95), percentile(timings, 99),
+      server.connections - connections)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
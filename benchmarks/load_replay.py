@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Simulates many households using the skill at once.  Devices arrive at a
+# given rate; each one launches the skill, asks for an artist and then sends
+# a stream of PlaybackNearlyFinished, PlaybackFinished and Next requests,
+# the way a playing Echo does.  Reports throughput, errors and latency.
+#
+# Against the skill in this process, with its own fake Kodi:
+#
+#   python benchmarks/load_replay.py --devices 100 --rate 10
+#
+# Against a gunicorn deployment (see local_app.py):
+#
+#   python benchmarks/fake_kodi.py 8080 10000 &
+#   gunicorn -w 4 --chdir benchmarks local_app:app &
+#   python benchmarks/load_replay.py --url http://127.0.0.1:8000/ --songs 10000
+#
+# --replay takes a file of recorded request bodies, one JSON object per line,
+# which every simulated device sends in order instead of the synthetic session.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import events
+import synthetic
+
+
+def percentile(timings, p):
+  timings = sorted(timings)
+  return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))] * 1000
+
+
+# Launch, pick an artist, then let the queue play
+def synthetic_session(rnd, artists, length, device_id, user_id):
+  def ev(*args, **kwargs):
+    return events.event(*args, device_id=device_id, user_id=user_id, **kwargs)
+
+  artist = synthetic.heard(rnd, rnd.choice(artists)['artist'])
+  session = [ev('LaunchRequest'), ev('IntentRequest', 'StreamArtist', {'Artist': artist})]
+  for i in range(length):
+    if rnd.random() < 0.2:
+      session.append(ev('IntentRequest', 'AMAZON.NextIntent'))
+    else:
+      session.append(ev('AudioPlayer.PlaybackNearlyFinished', extra=events.playback()))
+      session.append(ev('AudioPlayer.PlaybackFinished', extra=events.playback()))
+  return session
+
+
+class Results:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.timings = {}
+    self.errors = {}
+
+  def record(self, name, seconds, error=None):
+    with self.lock:
+      self.timings.setdefault(name, []).append(seconds)
+      if error:
+        self.errors.setdefault(name, {})
+        self.errors[name][error] = self.errors[name].get(error, 0) + 1
+
+
+def run_device(url, session, think, timeout, results, rnd):
+  http = requests.Session()
+  for body in session:
+    name = events.name(body)
+    start = time.time()
+    try:
+      r = http.post(url, data=json.dumps(body), headers={'Content-Type': 'application/json'}, timeout=timeout)
+      # flask-ask answers 400 when a handler returns nothing
+      error = 'HTTP %d' % r.status_code if r.status_code >= 500 else None
+    except requests.exceptions.RequestException as e:
+      error = e.__class__.__name__
+    results.record(name, time.time() - start, error)
+
+    if think:
+      time.sleep(rnd.expovariate(1.0 / think))
+
+
+def report(results, elapsed, devices):
+  total = sum(len(t) for t in results.timings.values())
+  errors = sum(sum(e.values()) for e in results.errors.values())
+  everything = [t for timings in results.timings.values() for t in timings]
+
+  print '%d devices, %d requests in %.1fs: %.1f requests/s, %d errors (%.2f%%)' % (
+    devices, total, elapsed, total / elapsed, errors, 100.0 * errors / max(total, 1))
+  print '  %-38s %7s %8s %8s %8s %8s' % ('', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms')
+  for name in sorted(results.timings):
+    timings = results.timings[name]
+    print '  %-38s %7d %8d %8.2f %8.2f %8.2f' % (name, len(timings), sum(results.errors.get(name, {}).values()),
+                                                 percentile(timings, 50), percentile(timings, 95), percentile(timings, 99))
+  print '  %-38s %7d %8d %8.2f %8.2f %8.2f' % ('all', total, errors, percentile(everything, 50),
+                                               percentile(everything, 95), percentile(everything, 99))
+
+  for name in sorted(results.errors):
+    for error, count in sorted(results.errors[name].items()):
+      print '  %s: %d x %s' % (name, count, error)
+
+
+# Serves the skill from this process with a threaded WSGI server, talking to
+# an in-process fake Kodi.  Returns the URL and the fake Kodi server.
+def start_local(songs, latency, backend):
+  from werkzeug.serving import make_server
+  import fake_kodi
+
+  kodi_server = fake_kodi.start(0, songs, latency)
+
+  import local_app
+  app = local_app.configure(kodi_server.server_address[1], backend)
+
+  server = make_server('127.0.0.1', 0, app, threaded=True)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  return 'http://127.0.0.1:%d/' % server.server_port, kodi_server
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay Alexa traffic against the skill')
+  parser.add_argument('--url', help='skill to send requests to (default: serve it from this process)')
+  parser.add_argument('--devices', type=int, default=50, help='number of simulated devices')
+  parser.add_argument('--rate', type=float, default=5.0, help='new devices per second')
+  parser.add_argument('--events', type=int, default=20, help='playback steps per device')
+  parser.add_argument('--think', type=float, default=0.2, help='mean seconds between a device\'s requests')
+  parser.add_argument('--songs', type=int, default=10000, help='size of the synthetic library')
+  parser.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency in ms (local only)')
+  parser.add_argument('--backend', default='sqlite', help='queue backend (local only)')
+  parser.add_argument('--replay', help='file of recorded request bodies, one per line')
+  parser.add_argument('--timeout', type=float, default=10.0, help='request timeout in seconds')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  rnd = random.Random(args.seed)
+  url = args.url
+  if url:
+    # fake_kodi.py builds the same library from the same seed
+    artists = synthetic.library(args.songs)[0]
+  else:
+    url, kodi_server = start_local(args.songs, args.latency / 1000, args.backend)
+    artists = kodi_server.kodi.artists
+
+  recorded = None
+  if args.replay:
+    with open(args.replay) as f:
+      recorded = [json.loads(line) for line in f if line.strip()]
+
+  # Warm up the library snapshot so the first devices don't all wait on it
+  requests.post(url, data=json.dumps(events.event('IntentRequest', 'StreamArtist', {'Artist': artists[0]['artist']},
+                                                  device_id='warmup')),
+                headers={'Content-Type': 'application/json'}, timeout=600)
+
+  results = Results()
+  threads = []
+  start = time.time()
+  arrival = start
+  for i in range(args.devices):
+    device_id = 'load-device-%d' % i
+    user_id = 'load-user-%d' % i
+    if recorded:
+      session = [events.retarget(body, device_id, user_id) for body in recorded]
+    else:
+      session = synthetic_session(rnd, artists, args.events, device_id, user_id)
+
+    arrival += rnd.expovariate(args.rate)
+    time.sleep(max(0, arrival - time.time()))
+
+    t = threading.Thread(target=run_device,
+                         args=(url, session, args.think, args.timeout, results, random.Random(rnd.random())))
+    t.daemon = True
+    t.start()
+    threads.append(t)
+
+  for t in threads:
+    t.join()
+
+  report(results, time.time() - start, args.devices)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
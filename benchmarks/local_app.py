@@ -0,0 +1,41 @@
+# The skill set up for benchmarking: Alexa request signatures aren't checked
+# and Kodi is the fake server from fake_kodi.py.  Can be served by gunicorn:
+#
+#   python benchmarks/fake_kodi.py 8080 10000 &
+#   gunicorn -w 4 -k gthread --threads 8 --chdir benchmarks local_app:app
+#
+# LOCAL_KODI_PORT (default 8080), LOCAL_QUEUE_BACKEND (default sqlite, so
+# that every gunicorn worker sees the same queues) and LOCAL_QUEUE_SQLITE_PATH
+# change where it looks.
+import os
+import sys
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import alexa
+
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'koko-benchmark.db')
+
+
+# Settings from the environment are only used when there's no kodi.config,
+# so the [DEFAULT] section is overridden instead.
+def configure(kodi_port, queue_backend='memory', sqlite_path=DEFAULT_SQLITE_PATH):
+  for option, value in [('scheme', 'http'), ('subpath', ''), ('address', '127.0.0.1'),
+                        ('port', str(kodi_port)), ('username', 'kodi'), ('password', 'kodi'),
+                        ('accept_music_warning', 'yes'), ('queue_backend', queue_backend),
+                        ('queue_sqlite_path', sqlite_path),
+                        # every simulated device talks to the same fake Kodi
+                        ('kodi_pool_size', '100'),
+                        ('cache_bucket', 'None'), ('owncloud_cache_url', 'None')]:
+    alexa.config.set('DEFAULT', option, value)
+  alexa.app.config['ASK_VERIFY_REQUESTS'] = False
+  alexa.app.config['ASK_APPLICATION_ID'] = None
+  logging.disable(logging.INFO)
+  return alexa.app
+
+
+app = configure(int(os.getenv('LOCAL_KODI_PORT', '8080')),
+                os.getenv('LOCAL_QUEUE_BACKEND', 'sqlite'),
+                os.getenv('LOCAL_QUEUE_SQLITE_PATH', DEFAULT_SQLITE_PATH))
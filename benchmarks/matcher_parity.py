@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Checks that the search index picks the same best match as kodi.matchHeard()
+# on a synthetic library, and compares how long each takes.
+#
+#   python benchmarks/matcher_parity.py [songs] [queries]
+
+import os
+import sys
+import time
+import random
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import search
+import synthetic
+from kodi_voice import KodiConfigParser, Kodi
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('kodi_voice').setLevel(logging.WARNING)
+logging.getLogger('kodi_alexa').setLevel(logging.WARNING)
+
+
+def best(located, key):
+  if located:
+    return located[0][key]
+  return None
+
+
+def main():
+  song_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+  # matchHeard only needs the language from the config
+  kodi = Kodi(KodiConfigParser(os.path.join(os.path.dirname(__file__), 'nonexistent.config')))
+  artists, albums, songs = synthetic.library(song_count)
+  rnd = random.Random(2)
+
+  for name, items, key in (('artists', artists, 'artist'), ('albums', albums, 'label'), ('songs', songs, 'label')):
+    start = time.time()
+    index = search.SearchIndex(items, key)
+    build_time = time.time() - start
+
+    mismatches = 0
+    linear_time = 0.0
+    index_time = 0.0
+    for _ in range(query_count):
+      heard = synthetic.heard(rnd, rnd.choice(items)[key])
+
+      start = time.time()
+      expected = best(kodi.matchHeard(heard, items, key), key)
+      linear_time += time.time() - start
+
+      start = time.time()
+      got = best(index.match(kodi, heard), key)
+      index_time += time.time() - start
+
+      if expected != got:
+        mismatches += 1
+        print '  mismatch for "%s": matchHeard=%r index=%r' % (heard, expected, got)
+
+    print '%-8s %7d items  build %.2fs  matchHeard %.1fms/query  index %.1fms/query  mismatches %d/%d' % (
+      name, len(items), build_time, linear_time * 1000 / query_count, index_time * 1000 / query_count,
+      mismatches, query_count)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Compares how long the queue storage backends take to handle the playback
+# events Alexa sends while a queue is playing.
+#
+#   python benchmarks/queue_backends.py [queue length] [events] [mongodb uri]
+#
+# Mongo is only included when a URI is given.  The database backends are
+# also run with write-behind on (queue_write_behind), which writes positions
+# after the response.
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import music
+from kodi_voice import KodiConfigParser, Kodi
+
+
+def percentile(timings, p):
+  timings = sorted(timings)
+  return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))] * 1000
+
+
+def run(kodi, queue_length, events):
+  files = ['/music/%d.mp3' % i for i in range(queue_length)]
+
+  start = time.time()
+  music.MusicPlayer(kodi, files)
+  create_time = time.time() - start
+
+  timings = {'nearly_finished': [], 'finished': [], 'stopped': []}
+  for i in range(events):
+    # PlaybackNearlyFinished only reads the queue
+    start = time.time()
+    playlist_queue = music.MusicPlayer(kodi)
+    playlist_queue.next_item
+    timings['nearly_finished'].append(time.time() - start)
+
+    # PlaybackStopped saves the offset
+    start = time.time()
+    playlist_queue = music.MusicPlayer(kodi)
+    playlist_queue.current_offset = i
+    playlist_queue.save()
+    timings['stopped'].append(time.time() - start)
+
+    # PlaybackFinished moves to the next song
+    start = time.time()
+    playlist_queue = music.MusicPlayer(kodi)
+    if playlist_queue.next_item:
+      playlist_queue.skip_song()
+    timings['finished'].append(time.time() - start)
+
+  return create_time, timings
+
+
+def main():
+  queue_length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  events = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  mongodb_uri = sys.argv[3] if len(sys.argv) > 3 else None
+
+  backends = [('memory', False), ('sqlite', False), ('sqlite', True)]
+  if mongodb_uri:
+    backends.extend([('mongo', False), ('mongo', True)])
+
+  print 'queue of %d songs, %d of each event' % (queue_length, events)
+  for backend, write_behind in backends:
+    config = KodiConfigParser(os.path.join(os.path.dirname(__file__), 'nonexistent.config'))
+    config.set('DEFAULT', 'queue_backend', backend)
+    config.set('DEFAULT', 'queue_sqlite_path', os.path.join(tempfile.mkdtemp(), 'queue.db'))
+    config.set('DEFAULT', 'queue_write_behind', 'yes' if write_behind else 'no')
+    if mongodb_uri:
+      config.set('DEFAULT', 'mongodb_uri', mongodb_uri)
+    kodi = Kodi(config)
+
+    create_time, timings = run(kodi, queue_length, events)
+    name = backend + (' (write-behind)' if write_behind else '')
+    print '%s\n        new queue        %7.2fms' % (name, create_time * 1000)
+    for event in ('nearly_finished', 'finished', 'stopped'):
+      print '        %-16s p50 %7.2fms  p95 %7.2fms  p99 %7.2fms' % (
+        event, percentile(timings[event], 50), percentile(timings[event], 95), percentile(timings[event], 99))
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
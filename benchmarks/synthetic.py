@@ -0,0 +1,71 @@
+# Synthetic music libraries shaped like the results of Kodi's AudioLibrary
+# JSON-RPC methods, for benchmarks that can't talk to a real Kodi box.
+import random
+
+WORDS = [
+  'love', 'night', 'heart', 'fire', 'dream', 'blue', 'river', 'light', 'summer',
+  'rain', 'city', 'gold', 'shadow', 'wild', 'dance', 'home', 'road', 'ghost',
+  'silver', 'stone', 'ocean', 'midnight', 'electric', 'paper', 'glass', 'sun',
+  'moon', 'star', 'velvet', 'thunder', 'broken', 'young', 'forever', 'lonely',
+  'sweet', 'little', 'black', 'white', 'red', 'crazy', 'kings', 'queen', 'angel',
+  'devil', 'highway', 'radio', 'morning', 'winter', 'garden', 'mirror', 'echo',
+  'neon', 'desert', 'north', 'south', 'storm', 'wolves', 'bridges', 'tiger',
+  'hollow', 'honey', 'cherry', 'diamond', 'island', 'memory', 'satellite',
+]
+
+SUFFIXES = ['', '', '', '', ' (live)', ' (remastered)', ' part two', ' ii', ' 2']
+
+
+def title(rnd, min_words=1, max_words=4):
+  words = [rnd.choice(WORDS) for _ in range(rnd.randint(min_words, max_words))]
+  return ' '.join(words).title() + rnd.choice(SUFFIXES)
+
+
+# Returns (artists, albums, songs) with roughly 10 songs per album and
+# 5 albums per artist.
+def library(songs=10000, seed=1):
+  rnd = random.Random(seed)
+  album_count = max(1, songs // 10)
+  artist_count = max(1, album_count // 5)
+
+  artists = []
+  for artist_id in range(1, artist_count + 1):
+    name = title(rnd, 1, 3)
+    artists.append({'artistid': artist_id, 'artist': name, 'label': name})
+
+  albums = []
+  for album_id in range(1, album_count + 1):
+    artist = rnd.choice(artists)
+    albums.append({'albumid': album_id, 'label': title(rnd, 1, 4), 'artistid': [artist['artistid']]})
+
+  tracks = []
+  for song_id in range(1, songs + 1):
+    album = albums[(song_id - 1) % album_count]
+    tracks.append({
+      'songid': song_id,
+      'label': title(rnd, 1, 5),
+      'file': '/music/%d/%d.mp3' % (album['albumid'], song_id),
+      'artistid': album['artistid'],
+      'albumartistid': album['artistid'],
+      'albumid': album['albumid'],
+    })
+
+  return artists, albums, tracks
+
+
+# What a user might say when asking for one of the titles: mostly the title
+# itself, sometimes mangled the way speech recognition tends to mangle things.
+def heard(rnd, name):
+  name = name.lower()
+  words = name.split()
+  roll = rnd.random()
+  if roll < 0.4 or len(words) < 2:
+    return name
+  elif roll < 0.6:
+    words.pop(rnd.randrange(len(words)))
+  elif roll < 0.8:
+    i = rnd.randrange(len(words))
+    words[i] = words[i][:-1] or words[i]
+  else:
+    words.append(rnd.choice(WORDS))
+  return ' '.join(words)
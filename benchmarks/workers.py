@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# Compares gunicorn worker classes when Kodi is slow to answer.  Starts the
+# fake Kodi server with the given latency, then serves the skill (see
+# local_app.py) with each worker class in turn, with the settings from
+# gunicorn_config.py, and has many devices play music through it at once.
+#
+#   python benchmarks/workers.py --latency 200 --clients 50 --workers 1
+#
+# Needs gunicorn, and gevent for the gevent worker.
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import events
+import synthetic
+import load_replay
+
+
+def free_port():
+  s = socket.socket()
+  s.bind(('127.0.0.1', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+
+# The gunicorn installed alongside this Python, if there is one
+def gunicorn_command():
+  command = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+  if os.path.exists(command):
+    return command
+  return 'gunicorn'
+
+
+def wait_for(url, process, timeout=60):
+  deadline = time.time() + timeout
+  while time.time() < deadline and process.poll() is None:
+    try:
+      requests.get(url, timeout=1)
+      return
+    except requests.exceptions.RequestException:
+      time.sleep(0.2)
+  raise Exception('%s did not come up' % (url))
+
+
+def start_gunicorn(worker_class, workers, kodi_port, sqlite_path):
+  port = free_port()
+  env = dict(os.environ, WORKER_CLASS=worker_class, LOCAL_KODI_PORT=str(kodi_port),
+             LOCAL_QUEUE_BACKEND='sqlite', LOCAL_QUEUE_SQLITE_PATH=sqlite_path)
+  args = [gunicorn_command(), '-c', os.path.join(REPO_DIR, 'gunicorn_config.py'),
+          '-w', str(workers), '-b', '127.0.0.1:%d' % (port), '--chdir', BENCHMARKS_DIR,
+          '--log-level', 'warning', 'local_app:app']
+  process = subprocess.Popen(args, env=env)
+  url = 'http://127.0.0.1:%d/' % (port)
+  wait_for(url, process)
+  return process, url
+
+
+# Artist, album and song requests are answered from the cached library, so
+# devices here mostly ask for the intents that have to wait on Kodi
+def kodi_session(rnd, steps, device_id, user_id):
+  def ev(*args, **kwargs):
+    return events.event(*args, device_id=device_id, user_id=user_id, **kwargs)
+
+  session = [ev('LaunchRequest')]
+  for i in range(steps):
+    session.append(rnd.choice([
+      ev('IntentRequest', 'StreamPartyMode'),
+      ev('IntentRequest', 'StreamAudioPlaylistRecent'),
+      ev('IntentRequest', 'StreamAudioPlaylist', {'AudioPlaylist': rnd.choice(synthetic.WORDS[:5])}),
+    ]))
+    session.append(ev('AudioPlayer.PlaybackNearlyFinished', extra=events.playback()))
+  return session
+
+
+def run(worker_class, args, kodi_port):
+  sqlite_path = os.path.join(tempfile.mkdtemp(), 'queues.db')
+  process, url = start_gunicorn(worker_class, args.workers, kodi_port, sqlite_path)
+  try:
+    for i in range(args.workers * 2):
+      requests.post(url, data=json.dumps(events.event('LaunchRequest', device_id='warmup')),
+                    headers={'Content-Type': 'application/json'}, timeout=600)
+
+    rnd = random.Random(args.seed)
+    results = load_replay.Results()
+    threads = []
+    start = time.time()
+    for i in range(args.clients):
+      session = kodi_session(rnd, args.events, 'device-%d' % i, 'user-%d' % i)
+      t = threading.Thread(target=load_replay.run_device,
+                           args=(url, session, 0, args.timeout, results, random.Random(rnd.random())))
+      t.daemon = True
+      t.start()
+      threads.append(t)
+    for t in threads:
+      t.join()
+
+    print '%s worker x %d, kodi latency %dms' % (worker_class, args.workers, args.latency)
+    load_replay.report(results, time.time() - start, args.clients)
+    print
+  finally:
+    process.terminate()
+    process.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare gunicorn worker classes against a slow Kodi')
+  parser.add_argument('--classes', default='sync,gevent', help='comma separated worker classes')
+  parser.add_argument('--workers', type=int, default=1, help='worker processes')
+  parser.add_argument('--clients', type=int, default=50, help='devices playing at once')
+  parser.add_argument('--events', type=int, default=5, help='playback steps per device')
+  parser.add_argument('--songs', type=int, default=1000, help='size of the synthetic library')
+  parser.add_argument('--latency', type=float, default=200.0, help='fake Kodi latency in ms')
+  parser.add_argument('--timeout', type=float, default=120.0, help='request timeout in seconds')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  kodi_port = free_port()
+  kodi = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_kodi.py'), str(kodi_port),
+                           str(args.songs), str(args.latency)], stdout=open(os.devnull, 'w'))
+  try:
+    wait_for('http://127.0.0.1:%d/' % (kodi_port), kodi)
+    for worker_class in args.classes.split(','):
+      run(worker_class, args, kodi_port)
+  finally:
+    kodi.terminate()
+    kodi.wait()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,70 @@
+import time
+import threading
+
+# Alexa gives up on a response after 8 seconds.  Intents get this long by
+# default (response_budget in kodi.config), in seconds.
+DEFAULT_BUDGET = 6.0
+
+# Seconds kept back from Kodi calls for building and sending the response
+RESERVE = 0.5
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+  pass
+
+
+# Sets the time budget for the request being handled on this thread:
+#
+#   with deadline.Budget(6.0):
+#     ...
+#
+# A budget of 0 or less means no deadline.
+class Budget:
+  def __init__(self, seconds):
+    self.seconds = seconds
+
+  def __enter__(self):
+    self.previous = getattr(_local, 'deadline', None)
+    _local.deadline = time.time() + self.seconds if self.seconds > 0 else None
+    return self
+
+  def __exit__(self, *exc):
+    _local.deadline = self.previous
+    return False
+
+
+# Seconds left for waiting on Kodi, or None if there's no deadline
+def remaining():
+  deadline = getattr(_local, 'deadline', None)
+  if deadline is None:
+    return None
+  return deadline - time.time() - RESERVE
+
+
+def expired():
+  left = remaining()
+  return left is not None and left <= 0
+
+
+# Limits (connect, read) timeouts for a request to what's left of the budget
+def timeouts(connect, read):
+  left = remaining()
+  if left is None:
+    return (connect, read)
+  if left <= 0:
+    raise DeadlineExceeded()
+  return (min(connect, left), min(read, left))
+
+
+# Waits for a threading.Event that another thread will set, for as long as
+# the budget allows
+def wait(event):
+  left = remaining()
+  if left is None:
+    event.wait()
+  elif left > 0:
+    event.wait(left)
+  if not event.is_set():
+    raise DeadlineExceeded()
@@ -2,114 +2,249 @@ import re
 import string
 import random
 import os
+import sys
+import json
+import hashlib
+import threading
+import Queue
 from kodi_voice import KodiConfigParser, Kodi
+from kodi_voice.kodi import RPCString
 
 config_file = os.path.join(os.path.dirname(__file__), "kodi.config")
 config = KodiConfigParser(config_file)
 
 kodi = Kodi(config)
 
-
-def most_words(l=[]):
-  longest = 0
-  for s in l:
-    if len(s.split()) > longest:
-      longest = len(s.split())
-  return longest
-
-
-def sort_by_words(l, longest):
-  distributed = []
-  for i in range(1, longest + 1):
-    dl = [s for s in l if len(s.split()) == i]
-    if dl:
-      distributed.append(dl)
-  return distributed
+# Number of items to ask Kodi for at a time when paging through the library
+DEFAULT_PAGE_SIZE = 5000
+DEFAULT_FETCH_THREADS = 4
+
+# With --incremental, fingerprints of the last fetch of each category are
+# kept here and slot files whose category hasn't changed aren't rewritten.
+FINGERPRINT_FILE = 'slot_fingerprints.json'
+
+
+def get_limit(option, default):
+  try:
+    limit = kodi.config.get('alexa', option)
+    if limit and limit != 'None':
+      return int(limit)
+  except:
+    pass
+  return default
+
+
+# Fetches a library category a page at a time using JSON-RPC limits, and
+# yields the items as the pages arrive.  After the first page, which says how
+# many items there are, the rest are fetched by a few threads at once.  At
+# most 2 * workers + 1 pages are held in memory: one being processed, up to
+# workers waiting in the queue, and one per worker waiting to join it.
+def paged(method, cat, params=None, page_size=None, workers=None):
+  if not page_size:
+    page_size = get_limit('slot_page_size', DEFAULT_PAGE_SIZE)
+  if not workers:
+    workers = get_limit('slot_fetch_threads', DEFAULT_FETCH_THREADS)
+
+  # RPCString adds the limits to the params it's given, so each page gets
+  # its own copy
+  def fetch(start):
+    resp = kodi.SendCommand(RPCString(method, dict(params) if params else None, limits=(start, start + page_size)))
+    return resp.get('result', {})
+
+  result = fetch(0)
+  for item in result.get(cat, []):
+    yield item
+
+  total = result.get('limits', {}).get('total', 0)
+  starts = range(page_size, total, page_size)
+  if not starts:
+    return
+
+  pending = Queue.Queue()
+  for start in starts:
+    pending.put(start)
+  # Bounded, so fetching can't get far ahead of processing
+  done = Queue.Queue(maxsize=workers)
+
+  def worker():
+    while True:
+      try:
+        start = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        done.put(fetch(start).get(cat, []))
+      except Exception as e:
+        done.put(e)
+
+  for i in range(min(workers, len(starts))):
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+
+  for i in range(len(starts)):
+    items = done.get()
+    if isinstance(items, Exception):
+      raise items
+    for item in items:
+      yield item
+
+
+def unpaged(resp, cat):
+  if 'result' in resp and cat in resp['result']:
+    return resp['result'][cat]
+  return []
 
 
-def clean_results(resp, cat, key, limit=None):
+# Picks up to limit names from items.  Names are grouped by number of words
+# as they stream in, and each group keeps a random sample (reservoir) of at
+# most limit distinct names, which is all the selection below can use.  A
+# duplicate of a name that isn't in the sample any more counts again, which
+# only slightly favours titles that appear many times.
+def clean_results(items, key, limit=None):
   if not limit:
-    try:
-      limit = kodi.config.get('alexa', 'slot_items_max')
-      if limit and limit != 'None':
-        limit = int(limit)
-      else:
-        limit = None
-    except:
-      limit = None
+    limit = get_limit('slot_items_max', None)
   if not limit:
     limit = 100
 
-  cleaned = []
-  if 'result' in resp and cat in resp['result']:
-    for v in retrieved['result'][cat]:
-      name = kodi.sanitize_name(v[key], normalize=False)
-      # omit titles with digits, as Amazon never passes numbers as digits
-      if not re.search(r'\d', name):
-        cleaned.append(name)
-
-  cleaned = {v.lower(): v for v in cleaned}.values()
-  cleaned = filter(None, cleaned)
-  random.shuffle(cleaned)
-
-  # distribute strings evenly by number of words
-  if len(cleaned) > limit:
-    longest = most_words(cleaned)
-    distributed = sort_by_words(cleaned, longest)
-    if distributed:
-      total = 0
-      cleaned = []
-      while total < limit:
-        for l in distributed:
-          if l:
-            total += 1
-            cleaned.append(l.pop())
-
-  # sort by number of words just for visibility
-  if cleaned:
-    longest = most_words(cleaned)
-    distributed = sort_by_words(cleaned, longest)
-    if distributed:
-      cleaned = []
-      for dl in distributed:
-        cleaned += [l for l in dl]
+  groups = {}
+  for v in items:
+    name = kodi.sanitize_name(v[key], normalize=False)
+    # omit titles with digits, as Amazon never passes numbers as digits
+    if not name or re.search(r'\d', name):
+      continue
+
+    group = groups.setdefault(len(name.split()), {'names': [], 'seen': set(), 'count': 0})
+    if name.lower() in group['seen']:
+      continue
+    group['count'] += 1
+
+    if len(group['names']) < limit:
+      group['names'].append(name)
+      group['seen'].add(name.lower())
+    else:
+      i = random.randrange(group['count'])
+      if i < limit:
+        group['seen'].discard(group['names'][i].lower())
+        group['names'][i] = name
+        group['seen'].add(name.lower())
+
+  return select(dict((words, group['names']) for words, group in groups.items()), limit)
+
+
+# Picks limit names spread evenly over the number of words, taking one name
+# of each length in turn until there are enough or every length runs out, and
+# returns them sorted by number of words just for visibility.  groups maps a
+# number of words to the names with that many words.
+def select(groups, limit):
+  lengths = sorted(groups)
+  for words in lengths:
+    random.shuffle(groups[words])
+
+  taken = dict((words, len(groups[words])) for words in lengths)
+  if sum(taken.values()) > limit:
+    taken = dict((words, 0) for words in lengths)
+    total = 0
+    while total < limit:
+      # each round takes one more name of every length that has one left
+      turn = [words for words in lengths if taken[words] < len(groups[words])]
+      if not turn:
+        break
+      for words in turn:
+        taken[words] += 1
+      total += len(turn)
 
+  cleaned = []
+  for words in lengths:
+    cleaned += groups[words][:taken[words]]
   return cleaned[:limit]
 
 
-def write_file(filename, items=[]):
-  print 'Writing: %s' % (filename)
-  f = open(filename, 'w')
-  for a in items:
-    f.write("%s\n" % a.encode("utf-8"))
-  f.close()
+# Order-independent fingerprint of the names in a category, built up as the
+# items stream past.
+class Fingerprint:
+  def __init__(self, key):
+    self.key = key
+    self.count = 0
+    self.total = 0
 
+  def watch(self, items):
+    for v in items:
+      name = v[self.key]
+      if isinstance(name, unicode):
+        name = name.encode('utf-8')
+      self.count += 1
+      self.total = (self.total + int(hashlib.md5(name).hexdigest()[:16], 16)) % (1 << 64)
+      yield v
 
-# Generate MUSICPLAYLISTS Slot
-retrieved = kodi.GetMusicPlaylists()
-cl = clean_results(retrieved, 'files', 'label')
-write_file('MUSICPLAYLISTS', cl)
+  def hexdigest(self, limit):
+    return '%d:%d:%016x' % (limit, self.count, self.total)
 
 
-# Generate MUSICGENRES Slot
-retrieved = kodi.GetMusicGenres()
-cl = clean_results(retrieved, 'genres', 'label')
-write_file('MUSICGENRES', cl)
+def load_fingerprints():
+  try:
+    with open(FINGERPRINT_FILE) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
 
 
-# Generate MUSICARTISTS Slot
-retrieved = kodi.GetMusicArtists()
-cl = clean_results(retrieved, 'artists', 'artist')
-write_file('MUSICARTISTS', cl)
+def save_fingerprints(fingerprints):
+  with open(FINGERPRINT_FILE + '.tmp', 'w') as f:
+    json.dump(fingerprints, f, indent=2, sort_keys=True)
+  os.rename(FINGERPRINT_FILE + '.tmp', FINGERPRINT_FILE)
 
 
-# Generate MUSICALBUMS Slot
-retrieved = kodi.GetAlbums()
-cl = clean_results(retrieved, 'albums', 'label')
-write_file('MUSICALBUMS', cl)
+def write_file(filename, items=[]):
+  print 'Writing: %s' % (filename)
+  f = open(filename, 'w')
+  for a in items:
+    f.write("%s\n" % a.encode("utf-8"))
+  f.close()
 
 
-# Generate MUSICSONGS Slot
-retrieved = kodi.GetSongs()
-cl = clean_results(retrieved, 'songs', 'label')
-write_file('MUSICSONGS', cl)
+# Each slot is fetched, cleaned and written on its own thread, so the whole
+# run takes about as long as the biggest category.
+SLOTS = [
+  ('MUSICPLAYLISTS', lambda: unpaged(kodi.GetMusicPlaylists(), 'files'), 'label'),
+  ('MUSICGENRES', lambda: unpaged(kodi.GetMusicGenres(), 'genres'), 'label'),
+  ('MUSICARTISTS', lambda: paged('AudioLibrary.GetArtists', 'artists', {'albumartistsonly': False}), 'artist'),
+  ('MUSICALBUMS', lambda: paged('AudioLibrary.GetAlbums', 'albums'), 'label'),
+  ('MUSICSONGS', lambda: paged('AudioLibrary.GetSongs', 'songs'), 'label'),
+]
+
+incremental = '--incremental' in sys.argv[1:]
+previous = load_fingerprints() if incremental else {}
+fingerprints = {}
+errors = []
+
+
+def generate_slot(filename, fetch, key):
+  try:
+    limit = get_limit('slot_items_max', None) or 100
+    fingerprint = Fingerprint(key)
+    cleaned = clean_results(fingerprint.watch(fetch()), key, limit)
+    fingerprints[filename] = fingerprint.hexdigest(limit)
+    if incremental and previous.get(filename) == fingerprints[filename] and os.path.exists(filename):
+      print 'Unchanged: %s' % (filename)
+    else:
+      write_file(filename, cleaned)
+  except Exception as e:
+    print 'Unable to generate %s: %s' % (filename, e)
+    errors.append(filename)
+
+
+threads = [threading.Thread(target=generate_slot, args=slot) for slot in SLOTS]
+for t in threads:
+  t.start()
+for t in threads:
+  t.join()
+
+# Categories that failed keep their old fingerprints, so they're rewritten
+# next time if they changed
+for filename, fingerprint in previous.items():
+  fingerprints.setdefault(filename, fingerprint)
+save_fingerprints(fingerprints)
+
+if errors:
+  raise SystemExit(1)
@@ -0,0 +1,21 @@
+# gunicorn settings, used by the Procfile:
+#
+#   gunicorn -c gunicorn_config.py alexa:app
+#
+# WORKER_CLASS picks how each worker process serves requests.  With the
+# default, sync, a worker handles one request at a time, so a few slow Kodi
+# boxes can keep every worker busy.  With gevent, the worker patches the
+# standard library before loading the skill, so requests to Kodi and Mongo
+# give way to other requests while they wait, and one process serves many
+# requests at once.  WORKER_CONNECTIONS caps how many it takes on.
+#
+# WEB_CONCURRENCY (read by gunicorn itself) sets the number of processes.
+import os
+
+worker_class = os.getenv('WORKER_CLASS') or 'sync'
+worker_connections = int(os.getenv('WORKER_CONNECTIONS') or 100)
+
+if worker_class == 'gevent':
+  # The skill has to be imported by the worker after patching, not by the
+  # master before it forks
+  preload_app = False
@@ -0,0 +1,179 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kodi_voice import Kodi
+from kodi_voice.kodi import RPCString, SORT_RANDOM, http_normalize_slashes
+
+import util
+import metrics
+import deadline
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CLIENT_CACHE_SIZE = 100
+
+# Most requests we put in a single JSON-RPC batch
+BATCH_SIZE = 500
+
+_clients = OrderedDict()
+_sessions = {}
+_lock = threading.Lock()
+
+_stats = {
+  'clients_created': 0,
+  'client_reuses': 0,
+  'sessions_created': 0,
+}
+
+
+# One keep-alive session per Kodi web server, shared by every client that
+# talks to it.
+def get_session(kodi):
+  key = (kodi.scheme, kodi.address, kodi.port)
+
+  with _lock:
+    session = _sessions.get(key)
+    if not session:
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=kodi.pool_size)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      _sessions[key] = session
+      _stats['sessions_created'] += 1
+  return session
+
+
+# Kodi client that sends JSON-RPC requests over a pooled connection instead
+# of opening a new one for every request.
+class KodiClient(Kodi):
+  def __init__(self, config=None, context=None, pool_size=None):
+    Kodi.__init__(self, config, context)
+    if not pool_size:
+      pool_size = util.get_int_option(self, 'kodi_pool_size', DEFAULT_POOL_SIZE, section='global')
+    self.pool_size = pool_size
+
+  def SendCommand(self, command, wait_resp=True, cache_resp=False):
+    if not metrics.enabled:
+      return self._send_command(command, wait_resp, cache_resp)[0]
+
+    start = time.time()
+    try:
+      resp, size = self._send_command(command, wait_resp, cache_resp)
+    except:
+      metrics.observe_rpc(command, time.time() - start, error=True)
+      raise
+    metrics.observe_rpc(command, time.time() - start, size)
+    return resp
+
+  # Returns the decoded response and its size in bytes (None if unknown)
+  def _send_command(self, command, wait_resp, cache_resp):
+    # Responses cached in S3/ownCloud go through kodi_voice's own cache path
+    if self.cache.enabled and cache_resp and wait_resp:
+      return Kodi.SendCommand(self, command, wait_resp, cache_resp), None
+
+    url = "%s://%s:%s/%s/%s" % (self.scheme, self.address, self.port, self.subpath, 'jsonrpc')
+    url = http_normalize_slashes(url)
+
+    log.info('Sending request to %s', url if self.logsensitive else '[hidden]')
+    log.debug(command)
+
+    timeout = (10, self.read_timeout)
+    if not wait_resp:
+      timeout = (10, self.read_timeout_async)
+    # Don't wait on Kodi past the request's deadline
+    timeout = deadline.timeouts(*timeout)
+
+    try:
+      r = get_session(self).post(url, data=command, auth=(self.username, self.password), timeout=timeout)
+    except requests.exceptions.Timeout as e:
+      if not wait_resp and isinstance(e, requests.exceptions.ReadTimeout):
+        # Fire-and-forget commands don't wait for Kodi to answer
+        return None, None
+      if deadline.expired():
+        raise deadline.DeadlineExceeded()
+      raise
+
+    if r.encoding is None:
+      r.encoding = 'utf-8'
+    return r.json(), len(r.content)
+
+  def matchHeard(self, heard, results, lookingFor='label', limit=10):
+    with metrics.timer('match'):
+      return Kodi.matchHeard(self, heard, results, lookingFor, limit)
+
+  def GetRandomSongsPath(self, limit):
+    return self.SendCommand(RPCString("AudioLibrary.GetSongs", sort=SORT_RANDOM, fields=["file"], limits=(0, limit)))
+
+  def GetAudioPlaylistItemsPath(self):
+    return self.SendCommand(RPCString("Playlist.GetItems", {"playlistid": 0}, fields=["file"]))
+
+  # Looks up the paths of many songs using JSON-RPC batch requests.  Returns
+  # a dict of song id to file path; songs Kodi doesn't know are left out.
+  #
+  # If the request's deadline passes after the first batch, the songs found
+  # so far are returned rather than none at all.
+  def GetSongsIdPath(self, song_ids):
+    paths = {}
+
+    for chunk in [song_ids[x:x+BATCH_SIZE] for x in range(0, len(song_ids), BATCH_SIZE)]:
+      if paths and deadline.expired():
+        log.warning('Out of time, looked up %d of %d songs', len(paths), len(song_ids))
+        break
+
+      batch = []
+      for i, song_id in enumerate(chunk):
+        batch.append({"jsonrpc": "2.0", "method": "AudioLibrary.GetSongDetails",
+                      "params": {"songid": int(song_id), "properties": ["file"]}, "id": i})
+
+      for resp in self.SendCommand(json.dumps(batch)) or []:
+        song = resp.get('result', {}).get('songdetails')
+        if song:
+          paths[song['songid']] = song['file']
+
+    return paths
+
+
+def device_id(context):
+  # When testing from the web simulator there is no context object
+  try:
+    return context.System.device.deviceId
+  except:
+    return 'Unknown Device'
+
+
+# Returns the Kodi client for the device making the request.  Clients are
+# kept for the life of the worker, up to kodi_client_cache_size of them.
+def get_kodi(config, context=None):
+  key = device_id(context)
+
+  with _lock:
+    kodi = _clients.pop(key, None)
+    if kodi:
+      _clients[key] = kodi
+      _stats['client_reuses'] += 1
+      return kodi
+
+  kodi = KodiClient(config, context)
+  cache_size = util.get_int_option(kodi, 'kodi_client_cache_size', DEFAULT_CLIENT_CACHE_SIZE, section='global')
+
+  with _lock:
+    _clients[key] = kodi
+    _stats['clients_created'] += 1
+    while len(_clients) > cache_size:
+      _clients.popitem(last=False)
+  return kodi
+
+
+def stats():
+  with _lock:
+    return dict(_stats, clients=len(_clients))
+
+metrics.register(metrics.Stats('koko_kodi', 'Kodi client and session reuse in this process.', stats,
+                               counters=tuple(_stats)))
@@ -0,0 +1,382 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import util
+import search
+import deadline
+import metrics
+from kodi_voice.kodi import RPCString
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+# Seconds before a snapshot is considered stale.  Stale data is still served
+# while a fresh copy is fetched in the background.  0 disables the cache.
+DEFAULT_TTL = 3600
+
+# Number of heard titles whose matches are remembered, and how many seconds
+# a title that matched nothing is remembered for.
+DEFAULT_RESOLUTION_CACHE_SIZE = 1000
+DEFAULT_NEGATIVE_TTL = 60
+
+# JSON-RPC method, params, properties and title key used for each category
+CATEGORIES = {
+  'artists': ('AudioLibrary.GetArtists', {'albumartistsonly': False}, None, 'artist'),
+  'albums': ('AudioLibrary.GetAlbums', None, ['artistid'], 'label'),
+  'songs': ('AudioLibrary.GetSongs', None, ['file', 'artistid', 'albumartistid', 'albumid'], 'label'),
+}
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+# Kodi couldn't be asked for a category and there's no earlier copy of it
+class LibraryUnavailable(Exception):
+  pass
+
+
+# Build the lookup tables and search index for a freshly fetched category
+def build_entry(category, items, candidates=search.DEFAULT_CANDIDATES):
+  entry = {
+    'items': items,
+    'fetched': time.time(),
+    'index': search.SearchIndex(items, CATEGORIES[category][3], candidates),
+    'by_id': {},
+    'by_artist': {},
+    'by_album': {},
+  }
+
+  if category == 'artists':
+    for item in items:
+      entry['by_id'][item['artistid']] = item
+  elif category == 'albums':
+    for item in items:
+      entry['by_id'][item['albumid']] = item
+      for artist_id in item.get('artistid', []):
+        entry['by_artist'].setdefault(artist_id, []).append(item)
+  elif category == 'songs':
+    for item in items:
+      entry['by_id'][item['songid']] = item
+      entry['by_album'].setdefault(item.get('albumid'), []).append(item)
+      # Kodi's artistid filter matches song artists and album artists
+      artist_ids = set(item.get('artistid', [])) | set(item.get('albumartistid', []))
+      for artist_id in artist_ids:
+        entry['by_artist'].setdefault(artist_id, []).append(item)
+
+  return entry
+
+
+# Matches for what users asked for, most recently used last.  People ask
+# for the same things over and over, so this saves matching the heard title
+# against the library again.  Titles that matched nothing are kept for
+# negative_ttl seconds only, in case they're being added to the library.
+class ResolutionCache:
+  def __init__(self, size=DEFAULT_RESOLUTION_CACHE_SIZE, negative_ttl=DEFAULT_NEGATIVE_TTL):
+    self.size = size
+    self.negative_ttl = negative_ttl
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  # Titles that matched nothing are only remembered if cache_misses is set
+  def get(self, key, resolve, cache_misses=True):
+    with self._lock:
+      found = self._entries.pop(key, None)
+      if found and (found[1] is None or found[1] > time.time()):
+        self._entries[key] = found
+        if found[0]:
+          self.hits += 1
+        else:
+          self.negative_hits += 1
+        outcome = 'hit' if found[0] else 'negative_hit'
+      else:
+        self.misses += 1
+        found = None
+        outcome = 'miss'
+
+    if metrics.enabled:
+      metrics.resolutions.inc((key[0], outcome))
+    if found:
+      return found[0]
+
+    result = resolve()
+    if self.size > 0 and (result or cache_misses):
+      with self._lock:
+        self._entries[key] = (result, None if result else time.time() + self.negative_ttl)
+        while len(self._entries) > self.size:
+          self._entries.popitem(last=False)
+    return result
+
+  def clear(self):
+    with self._lock:
+      self._entries = OrderedDict()
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.negative_hits + self.misses
+      return {
+        'hits': self.hits,
+        'negative_hits': self.negative_hits,
+        'misses': self.misses,
+        'hit_rate': float(self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        'entries': len(self._entries),
+      }
+
+
+# Heard titles are looked up by their words, whatever the spacing.  Numbers
+# are heard differently in each language, so that's part of the key.
+def resolution_key(kind, heard, scope=None, language=None):
+  return (kind, scope, language, ' '.join(heard.split()))
+
+
+# In-memory copy of the music library for a single Kodi instance
+class LibrarySnapshot:
+  def __init__(self, ttl=DEFAULT_TTL, candidates=search.DEFAULT_CANDIDATES, resolutions=None):
+    self.ttl = ttl
+    self.candidates = candidates
+    # Cleared whenever the library is fetched again
+    self.resolutions = resolutions or ResolutionCache()
+    self.hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self.errors = 0
+    self._entries = {}
+    self._refreshing = set()
+    self._fetching = {}
+    self._lock = threading.Lock()
+
+  def get(self, kodi, category):
+    entry = None
+    fetching = None
+    with self._lock:
+      if self.ttl > 0:
+        entry = self._entries.get(category)
+
+      if entry:
+        self.hits += 1
+        if time.time() - entry['fetched'] > self.ttl and category not in self._refreshing:
+          self._refreshing.add(category)
+          t = threading.Thread(target=self.fetch, args=(kodi, category))
+          t.daemon = True
+          t.start()
+      else:
+        self.misses += 1
+        # With a deadline to keep, missing categories are fetched in the
+        # background, all at once since most intents need more than one,
+        # so they can finish for a later request if this one has to give up
+        # waiting for them
+        if self.ttl > 0 and deadline.remaining() is not None:
+          self.start_fetching(kodi, CATEGORIES)
+        fetching = self._fetching.get(category)
+
+    if entry:
+      return entry
+    if fetching:
+      deadline.wait(fetching)
+      with self._lock:
+        entry = self._entries.get(category)
+      if not entry:
+        raise LibraryUnavailable(category)
+      return entry
+    return self.refresh(kodi, category)
+
+  # Starts loading any of the categories that aren't cached yet in the
+  # background, so they're fetched from Kodi at the same time rather than
+  # one after another as get() asks for them.  Under a deadline, get()
+  # starts every missing category itself.
+  def prefetch(self, kodi, categories):
+    if self.ttl <= 0:
+      return
+    with self._lock:
+      self.start_fetching(kodi, categories)
+
+  # Fetches each category that isn't cached or already on its way on a
+  # thread of its own; get() waits for them.  Called with the lock held.
+  def start_fetching(self, kodi, categories):
+    for category in categories:
+      if category not in self._entries and category not in self._fetching:
+        self._fetching[category] = threading.Event()
+        t = threading.Thread(target=self.fetch, args=(kodi, category, self._fetching[category]))
+        t.daemon = True
+        t.start()
+
+  # refresh() for a background thread, which has nobody to tell of failures
+  # beyond the log
+  def fetch(self, kodi, category, fetching=None):
+    try:
+      self.refresh(kodi, category)
+    except LibraryUnavailable:
+      pass
+    finally:
+      if fetching:
+        with self._lock:
+          self._fetching.pop(category, None)
+        fetching.set()
+
+  def refresh(self, kodi, category):
+    method, params, fields = CATEGORIES[category][:3]
+    log.info('Fetching %s for library snapshot', category)
+
+    try:
+      data = kodi.SendCommand(RPCString(method, params, fields=fields))
+      items = data['result'].get(category, [])
+    except:
+      log.exception('Unable to fetch %s from Kodi', category)
+      items = None
+
+    with self._lock:
+      self._refreshing.discard(category)
+      if items is None:
+        self.errors += 1
+        # Keep serving what we had.  Without it, the request fails rather
+        # than finding nothing, which would be remembered as a miss.
+        entry = self._entries.get(category)
+        if not entry:
+          raise LibraryUnavailable(category)
+        return entry
+      self.refreshes += 1
+
+    entry = build_entry(category, items, self.candidates)
+
+    with self._lock:
+      if self.ttl > 0:
+        self._entries[category] = entry
+      self.resolutions.clear()
+      return entry
+
+  def invalidate(self):
+    with self._lock:
+      self._entries = {}
+      self.resolutions.clear()
+
+  def stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'refreshes': self.refreshes,
+        'errors': self.errors,
+        'categories': dict((k, len(v['items'])) for k, v in self._entries.items()),
+        'resolutions': self.resolutions.stats(),
+      }
+
+
+# Snapshots are shared by everything in this process that talks to the same
+# Kodi instance.
+def get_snapshot(kodi):
+  key = (kodi.scheme, kodi.address, kodi.port, kodi.subpath)
+
+  with _snapshots_lock:
+    snapshot = _snapshots.get(key)
+    if not snapshot:
+      resolutions = ResolutionCache(util.get_int_option(kodi, 'resolution_cache_size', DEFAULT_RESOLUTION_CACHE_SIZE),
+                                    util.get_int_option(kodi, 'negative_cache_ttl', DEFAULT_NEGATIVE_TTL))
+      snapshot = LibrarySnapshot(util.get_int_option(kodi, 'library_cache_ttl', DEFAULT_TTL),
+                                 util.get_int_option(kodi, 'search_candidates', search.DEFAULT_CANDIDATES),
+                                 resolutions)
+      _snapshots[key] = snapshot
+  return snapshot
+
+
+SNAPSHOT_COUNTERS = ('hits', 'misses', 'refreshes', 'errors')
+
+
+# Snapshot counters added up over every Kodi instance this process talks
+# to, with the number of items cached in each category
+def stats():
+  with _snapshots_lock:
+    snapshots = _snapshots.values()
+
+  totals = dict((name, 0) for name in SNAPSHOT_COUNTERS + tuple(CATEGORIES) + ('resolution_entries',))
+  for snapshot in snapshots:
+    snapshot_stats = snapshot.stats()
+    for name in SNAPSHOT_COUNTERS:
+      totals[name] += snapshot_stats[name]
+    for category, count in snapshot_stats['categories'].items():
+      totals[category] += count
+    totals['resolution_entries'] += snapshot_stats['resolutions']['entries']
+  return totals
+
+metrics.register(metrics.Stats('koko_library', 'Library snapshot use in this process.', stats,
+                               counters=SNAPSHOT_COUNTERS))
+
+
+# Request-scoped view of the snapshot for the Kodi instance being used.
+# Heard titles are matched in the language of the request, if it's given.
+class Library:
+  def __init__(self, kodi, language=None):
+    self.kodi = kodi
+    self.language = language or kodi.language
+    self.snapshot = get_snapshot(kodi)
+
+  def artists(self):
+    return self.snapshot.get(self.kodi, 'artists')['items']
+
+  def albums(self):
+    return self.snapshot.get(self.kodi, 'albums')['items']
+
+  def songs(self):
+    return self.snapshot.get(self.kodi, 'songs')['items']
+
+  def prefetch(self, *categories):
+    self.snapshot.prefetch(self.kodi, categories)
+
+  # Looks a heard title up in a category, through the resolution cache.  A
+  # title that matched nothing isn't remembered if the category is empty,
+  # as it is while Kodi is still scanning.
+  def resolve(self, key, category, resolve):
+    entry = self.snapshot.get(self.kodi, category)
+    return self.snapshot.resolutions.get(key, lambda: resolve(entry), cache_misses=bool(entry['items']))
+
+  # Same results as kodi.matchHeard() over the full lists, via the index
+  def find_artist(self, heard):
+    return self.resolve(resolution_key('artist', heard, language=self.language), 'artists',
+                        lambda entry: entry['index'].match(self.kodi, heard, language=self.language))
+
+  def find_album(self, heard):
+    return self.resolve(resolution_key('album', heard, language=self.language), 'albums',
+                        lambda entry: entry['index'].match(self.kodi, heard, language=self.language))
+
+  def find_song(self, heard):
+    return self.resolve(resolution_key('song', heard, language=self.language), 'songs',
+                        lambda entry: entry['index'].match(self.kodi, heard, language=self.language))
+
+  # kodi.matchHeard() over one artist's albums or songs
+  def find_artist_album(self, artist_id, heard):
+    return self.resolve(resolution_key('artist_album', heard, artist_id, language=self.language), 'albums',
+                        lambda entry: search.match_heard(self.kodi, heard, self.albums_with_artist(entry, artist_id),
+                                                         language=self.language))
+
+  def find_artist_song(self, artist_id, heard):
+    return self.resolve(resolution_key('artist_song', heard, artist_id, language=self.language), 'songs',
+                        lambda entry: search.match_heard(self.kodi, heard, entry['by_artist'].get(artist_id, []),
+                                                         language=self.language))
+
+  def artist_albums(self, artist_id):
+    return self.albums_with_artist(self.snapshot.get(self.kodi, 'albums'), artist_id)
+
+  # Kodi's artistid filter on albums also matches the artists of the songs
+  # on them, so compilations and featured artists count as well, in library
+  # order
+  def albums_with_artist(self, albums, artist_id):
+    own = albums['by_artist'].get(artist_id, [])
+    album_ids = set(song.get('albumid') for song in self.artist_songs(artist_id))
+    album_ids.difference_update(album['albumid'] for album in own)
+    album_ids.intersection_update(albums['by_id'])
+    if not album_ids:
+      return own
+
+    album_ids.update(album['albumid'] for album in own)
+    return [album for album in albums['items'] if album['albumid'] in album_ids]
+
+  def artist_songs(self, artist_id):
+    return self.snapshot.get(self.kodi, 'songs')['by_artist'].get(artist_id, [])
+
+  def album_songs(self, album_id):
+    return self.snapshot.get(self.kodi, 'songs')['by_album'].get(album_id, [])
+
+  def song(self, song_id):
+    return self.snapshot.get(self.kodi, 'songs')['by_id'].get(song_id)
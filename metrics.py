@@ -0,0 +1,268 @@
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+
+import util
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+# Set by setup().  While it's False nothing is recorded, the timers below are
+# shared do-nothing objects and no request hooks are installed.
+enabled = False
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_method_re = re.compile(r'"method"\s*:\s*"([^"]+)"')
+
+
+class Histogram:
+  def __init__(self, name, documentation, labels, buckets):
+    self.name = name
+    self.documentation = documentation
+    self.labels = labels
+    self.buckets = buckets
+    self.series = {}
+    self.lock = threading.Lock()
+
+  def observe(self, label_values, value):
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      series = self.series.get(label_values)
+      if series is None:
+        # One count per bucket plus +Inf, then the sum
+        series = [0] * (len(self.buckets) + 1) + [0.0]
+        self.series[label_values] = series
+      series[i] += 1
+      series[-1] += value
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % (self.name)]
+
+    with self.lock:
+      series = sorted((k, list(v)) for k, v in self.series.items())
+
+    for label_values, counts in series:
+      labels = format_labels(self.labels, label_values)
+      total = 0
+      for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+        total += count
+        lines.append('%s_bucket{%s} %d' % (self.name, join_labels(labels, 'le="%s"' % (bound)), total))
+      lines.append('%s_sum{%s} %r' % (self.name, labels, counts[-1]))
+      lines.append('%s_count{%s} %d' % (self.name, labels, total))
+    return lines
+
+
+class Counter:
+  def __init__(self, name, documentation, labels):
+    self.name = name
+    self.documentation = documentation
+    self.labels = labels
+    self.series = {}
+    self.lock = threading.Lock()
+
+  def inc(self, label_values, amount=1):
+    with self.lock:
+      self.series[label_values] = self.series.get(label_values, 0) + amount
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % (self.name)]
+    with self.lock:
+      for label_values, value in sorted(self.series.items()):
+        lines.append('%s{%s} %d' % (self.name, format_labels(self.labels, label_values), value))
+    return lines
+
+
+# Counters other modules keep for themselves, read when /metrics is
+# scraped.  collect returns a dict of numbers; each becomes a metric named
+# <prefix>_<key>, a counter if the key is in counters and a gauge otherwise.
+class Stats:
+  def __init__(self, prefix, documentation, collect, counters=()):
+    self.prefix = prefix
+    self.documentation = documentation
+    self.collect = collect
+    self.counters = counters
+
+  def render(self):
+    lines = []
+    values = self.collect()
+    for key in sorted(values):
+      name = '%s_%s' % (self.prefix, key)
+      kind = 'gauge'
+      if key in self.counters:
+        name += '_total'
+        kind = 'counter'
+      value = values[key]
+      lines.append('# HELP %s %s' % (name, self.documentation))
+      lines.append('# TYPE %s %s' % (name, kind))
+      lines.append('%s %r' % (name, value) if isinstance(value, float) else '%s %d' % (name, value))
+    return lines
+
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+  return ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+def join_labels(*labels):
+  return ','.join(l for l in labels if l)
+
+
+intent_seconds = Histogram('koko_intent_seconds', 'Time spent handling Alexa requests.', ('intent',), LATENCY_BUCKETS)
+intent_response_bytes = Histogram('koko_intent_response_bytes', 'Size of responses sent to Alexa.', ('intent',), SIZE_BUCKETS)
+rpc_seconds = Histogram('koko_rpc_seconds', 'Time spent on Kodi JSON-RPC requests.', ('method',), LATENCY_BUCKETS)
+rpc_request_bytes = Histogram('koko_rpc_request_bytes', 'Size of Kodi JSON-RPC requests.', ('method',), SIZE_BUCKETS)
+rpc_response_bytes = Histogram('koko_rpc_response_bytes', 'Size of Kodi JSON-RPC responses.', ('method',), SIZE_BUCKETS)
+rpc_errors = Counter('koko_rpc_errors_total', 'Kodi JSON-RPC requests that raised an exception.', ('method',))
+queue_seconds = Histogram('koko_queue_seconds', 'Time spent on queue storage operations.', ('backend', 'operation'), LATENCY_BUCKETS)
+operation_seconds = Histogram('koko_operation_seconds', 'Time spent in other steps of a request.', ('operation',), LATENCY_BUCKETS)
+deadlines_exceeded = Counter('koko_deadlines_exceeded_total', 'Intents that ran out of time waiting on Kodi.', ('intent',))
+resolutions = Counter('koko_resolution_cache_total', 'Lookups of heard titles in the resolution cache.', ('kind', 'result'))
+
+REGISTRY = [intent_seconds, intent_response_bytes, rpc_seconds, rpc_request_bytes, rpc_response_bytes, rpc_errors,
+            queue_seconds, operation_seconds, deadlines_exceeded, resolutions]
+
+
+# Adds a module's own Stats to what /metrics reports
+def register(stats):
+  REGISTRY.append(stats)
+
+
+class Timer:
+  def __init__(self, histogram, label_values):
+    self.histogram = histogram
+    self.label_values = label_values
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(self.label_values, time.time() - self.start)
+    return False
+
+
+class NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+NULL_TIMER = NullTimer()
+
+
+# Times a step of handling a request, e.g. with metrics.timer('match'): ...
+def timer(operation):
+  if not enabled:
+    return NULL_TIMER
+  return Timer(operation_seconds, (operation,))
+
+
+# Name to file a Kodi JSON-RPC command under.  Batches are labelled with the
+# method of their first request.
+def rpc_method(command):
+  match = _method_re.search(command)
+  method = match.group(1) if match else 'unknown'
+  if command.lstrip().startswith('['):
+    method += '[batch]'
+  return method
+
+
+def observe_rpc(command, seconds, response_bytes=None, error=False):
+  method = rpc_method(command)
+  rpc_seconds.observe((method,), seconds)
+  rpc_request_bytes.observe((method,), len(command))
+  if response_bytes is not None:
+    rpc_response_bytes.observe((method,), response_bytes)
+  if error:
+    rpc_errors.inc((method,))
+
+
+# Wraps a storage.QueueStore so every operation on it is timed
+class TimedStore:
+  OPERATIONS = ('load', 'files', 'create', 'update', 'extend')
+
+  def __init__(self, store, backend):
+    self.store = store
+    self.backend = backend
+
+  def __getattr__(self, name):
+    attr = getattr(self.store, name)
+    if name not in self.OPERATIONS:
+      return attr
+
+    def timed(*args, **kwargs):
+      with Timer(queue_seconds, (self.backend, name)):
+        return attr(*args, **kwargs)
+    return timed
+
+
+def render():
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
+
+
+# flask-ask's request is a proxy, so it's never None itself; for anything
+# that isn't an Alexa request (health checks, 404s) there's just no type
+def request_name(ask_request):
+  try:
+    request_type = getattr(ask_request, 'type', None)
+  except RuntimeError:
+    request_type = None
+
+  if not request_type:
+    return 'unknown'
+  if request_type == 'IntentRequest':
+    return ask_request.intent.name
+  return request_type
+
+
+# Turns metrics on if metrics_enabled is set in the [global] section of
+# kodi.config (or the METRICS_ENABLED environment variable), and adds the
+# request hooks and the /metrics route to the app.
+def setup(app, config):
+  global enabled
+
+  try:
+    value = config.get('global', 'metrics_enabled')
+  except:
+    value = None
+  if not value or value == 'None':
+    value = os.getenv('METRICS_ENABLED')
+
+  enabled = value in util.accepted_answers
+  if not enabled:
+    return
+
+  from flask import g, Response
+  from flask_ask import request as ask_request
+
+  log.info('Recording metrics')
+
+  @app.before_request
+  def start_timer():
+    g.metrics_start = time.time()
+
+  @app.after_request
+  def record_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if start is not None:
+      name = request_name(ask_request)
+      intent_seconds.observe((name,), time.time() - start)
+      intent_response_bytes.observe((name,), response.calculate_content_length() or 0)
+    return response
+
+  @app.route('/metrics')
+  def metrics_endpoint():
+    # Don't count scrapes as requests
+    g.metrics_start = None
+    return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -1,88 +1,291 @@
 import os
+import logging
 
-def has_music_functionality(kodi):
-  try:
-    import pymongo
-  except:
-    return False
+import util
+import storage
+import metrics
+import shuffle
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+# Number of songs either side of the current one to build stream URLs for
+DEFAULT_STREAM_WINDOW = 2
 
+# Party mode queues this many random songs at a time, and fetches more when
+# fewer than PARTY_REFILL are left to play.
+DEFAULT_PARTY_BATCH_SIZE = 50
+PARTY_REFILL = 5
+
+# New party songs are checked against this many of the latest ones queued,
+# and once this many have been played they're dropped from the queue.
+DEFAULT_PARTY_HISTORY = 200
+
+
+def has_music_functionality(kodi):
   accepted_answers = ['y', 'yes', 'Y', 'Yes', 'YES', 'true', 'True']
   accepted_warning = kodi.config.get(kodi.dev_cfg_section, 'accept_music_warning')
 
   if accepted_warning in accepted_answers:
-    if kodi.config.get(kodi.dev_cfg_section, 'mongodb_uri'):
-      return True
-    else:
-      return False
+    return storage.is_configured(kodi)
   else:
     return False
 
+# Each Echo device gets its own queue.  With queue_per_user enabled, each
+# user on a device gets their own queue as well.
+def queue_key(kodi, user_id=None):
+  if not util.get_bool_option(kodi, 'queue_per_user'):
+    user_id = None
+  return {"device_id": kodi.deviceId, "user_id": user_id}
+
+
+def party_batch_size(kodi):
+  return util.get_int_option(kodi, 'party_batch_size', DEFAULT_PARTY_BATCH_SIZE)
+
+
+def party_history(kodi):
+  return util.get_int_option(kodi, 'party_history', DEFAULT_PARTY_HISTORY)
+
+
+# Sources whose songs can be asked of Kodi again, so their queues don't need
+# to store the file paths at all.
+RESOLVABLE_SOURCES = ('album', 'artist')
+
+
+# Paths of an album's or artist's songs, straight from Kodi in library
+# order.  Queues for a source are made from this list and their positions
+# are looked up in it again later, so both come from the same call.
+def fetch_source_files(kodi, source):
+  if source['type'] == 'album':
+    response = kodi.GetAlbumSongsPath(source['id'])
+  else:
+    response = kodi.GetArtistSongsPath(source['id'])
+
+  try:
+    return [song['file'] for song in response['result']['songs']]
+  except (KeyError, TypeError):
+    return []
+
+
+# Paths for a queue made from a source, fetched only when a path is needed.
+#
+# The queue's order was built for the number of songs the source had when
+# it was made.  If that has changed, positions no longer mean the same songs,
+# so no paths are returned and the queue ends after the current song rather
+# than playing something else.
+def source_files(kodi, source):
+  files = fetch_source_files(kodi, source)
+  if len(files) != source.get('count'):
+    log.warning('%s %s now has %d songs instead of %s, ending the queue',
+                source['type'], source['id'], len(files), source.get('count'))
+    return []
+  return files
+
+
+# The queue holds Kodi file paths.  Stream URLs are only built for the songs
+# around the current one, and only their paths are read from the store, so
+# the size of the queue doesn't affect how long a playback event takes.
+#
+# Shuffled queues keep the files in their original order plus a seed; the
+# song at each position comes from a permutation built from the seed.
 class MusicPlayer:
-  def __init__(self, kodi=None, urls=[]):
-    from pymongo import MongoClient
-    self.mongo_uri = kodi.config.get(kodi.dev_cfg_section, 'mongodb_uri')
-    self.client = MongoClient(self.mongo_uri)
+  # source describes where the songs came from, e.g. {'type': 'party'} or
+  # {'type': 'album', 'id': 12}
+  def __init__(self, kodi=None, files=[], user_id=None, source=None, shuffle=False):
+    self.kodi = kodi
+    self.store = storage.get_store(kodi)
+    self.key = queue_key(kodi, user_id)
+    self.window_size = util.get_int_option(kodi, 'stream_window', DEFAULT_STREAM_WINDOW)
+    self.window = {}
 
-    database_name = self.mongo_uri.rsplit('/', 1)[1]
-    self.db = self.client[database_name]
-    self.playlists = self.db['playlist-info']
+    if len(files) > 0:
+      self.clean_init(files, source, shuffle)
+    else:
+      self.load()
 
-    if len(urls) > 0:
-      self.clean_init(urls)
+  # File paths for positions in the queue, as a dict of position to path.
+  # self.files is only set when the whole queue is already in memory.
+  def tracks(self, indexes):
+    if self.order is not None:
+      positions = dict((i, self.order[i]) for i in indexes)
     else:
-      self.load_from_mongo()
+      positions = dict((i, i) for i in indexes)
+
+    if self.files is None and self.source and self.source.get('type') in RESOLVABLE_SOURCES:
+      self.files = source_files(self.kodi, self.source)
+
+    if self.files is not None:
+      return dict((i, self.files[p]) for i, p in positions.items() if p < len(self.files))
+
+    found = self.store.files(self.key, self.generation, positions.values())
+    return dict((i, found[p]) for i, p in positions.items() if p in found)
+
+  # Stream URL for a position in the queue, or None if it's out of range
+  def stream_url(self, index):
+    if index < 0 or index >= self.length:
+      return None
 
+    if index not in self.window:
+      self.fill_window(index)
+    return self.window.get(index)
+
+  def fill_window(self, index):
+    first = max(0, index - self.window_size)
+    last = min(self.length, index + self.window_size + 1)
+
+    self.window = dict((i, url) for i, url in self.window.items() if first <= i < last)
+    missing = [i for i in range(first, last) if i not in self.window]
+    with metrics.timer('stream_window'):
+      for i, path in self.tracks(missing).items():
+        self.window[i] = self.kodi.PrepareDownload(path)
+
+  # Party mode queues are topped up here, since every handler that moves
+  # through the queue asks for the next item first.
   @property
   def next_item(self):
-    if self.current_index < (len(self.urls) - 1):
-      return self.urls[self.current_index + 1]
-    else:
-      return None
+    if self.source and self.source.get('type') == 'party':
+      if self.length - self.current_index <= PARTY_REFILL:
+        self.top_up()
+    return self.stream_url(self.current_index + 1)
+
+  def top_up(self):
+    history = party_history(self.kodi)
+    songs = self.kodi.GetRandomSongsPath(party_batch_size(self.kodi))
+    try:
+      recent = set(self.tracks(range(max(0, self.length - history), self.length)).values())
+      files = [song['file'] for song in songs['result']['songs'] if song['file'] not in recent]
+    except (KeyError, TypeError):
+      log.info('Unable to fetch more songs for party mode')
+      return False
+
+    if not files:
+      return False
+
+    if self.current_index >= history:
+      self.trim(files)
+      return True
+
+    if self.store.extend(self.key, self.version, files):
+      if self.files is not None:
+        self.files = self.files + files
+      self.length += len(files)
+      self.set_order()
+      self.version += 1
+      return True
+
+    log.info('Queue was changed by another request, reloading')
+    self.load()
+    return False
+
+  # Starts the queue again from the songs around the current one, followed
+  # by files, so a long party doesn't keep every song it has played.  Like
+  # clean_init, this replaces the queue whatever its version.
+  def trim(self, files):
+    first = max(0, self.current_index - self.window_size)
+    kept = self.tracks(range(first, self.length))
+    positions = sorted(kept)
+
+    self.files = [kept[i] for i in positions] + files
+    self.length = len(self.files)
+    self.current_index = len([i for i in positions if i < self.current_index])
+    self.seed = None
+    self.set_order()
+    self.window = {}
+
+    self.version = self.store.create(self.key, {
+      "files": self.files,
+      "source": self.source,
+      "seed": self.seed,
+      "current_item": self.current_item,
+      "current_index": self.current_index,
+      "current_offset": self.current_offset
+    })
 
   @property
   def prev_item(self):
-    if self.current_index > 0:
-      return self.urls[self.current_index - 1]
-    else:
-      return None
+    return self.stream_url(self.current_index - 1)
 
+  # Returns False if another request moved the queue first, in which case
+  # the queue is reloaded and left where that request put it.
   def skip_song(self):
     self.current_offset = 0
     self.current_index += 1
-    self.current_item = self.urls[self.current_index]
+    self.current_item = self.stream_url(self.current_index)
 
-    self.save_to_mongo()
+    return self.save()
 
   def prev_song(self):
     self.current_offset = 0
     self.current_index -= 1
-    self.current_item = self.urls[self.current_index]
+    self.current_item = self.stream_url(self.current_index)
+
+    return self.save()
 
-    self.save_to_mongo()
+  def set_order(self):
+    if self.seed is None:
+      self.order = None
+    else:
+      self.order = shuffle.Permutation(self.length, self.seed)
 
-  def clean_init(self, urls):
-    self.urls = urls
-    self.current_item = urls[0]
+  # Replaces the queue in one write.  The version keeps counting up from the
+  # previous queue so requests still holding the old one can't update it.
+  def clean_init(self, files, source=None, shuffled=False):
+    self.files = files
+    self.length = len(files)
+    self.source = source
+    self.seed = shuffle.new_seed() if shuffled else None
+    self.set_order()
+    self.window = {}
     self.current_index = 0
+    self.current_item = self.stream_url(0)
     self.current_offset = 0
 
-    self.save_to_mongo()
+    stored_files = self.files
+    if self.source and self.source.get('type') in RESOLVABLE_SOURCES:
+      self.source = dict(self.source, count=len(self.files))
+      stored_files = []
+
+    self.version = self.store.create(self.key, {
+      "files": stored_files,
+      "source": self.source,
+      "seed": self.seed,
+      "current_item": self.current_item,
+      "current_index": self.current_index,
+      "current_offset": self.current_offset
+    })
 
-  def load_from_mongo(self):
-    playlist_data = self.playlists.find_one()
-    self.urls = playlist_data['urls']
-    self.current_item = playlist_data['current_item']
-    self.current_index = playlist_data['current_index']
-    self.current_offset = playlist_data['current_offset']
+  def load(self):
+    playlist_data = self.store.load(self.key)
+    if not playlist_data:
+      playlist_data = {}
 
-  def save_to_mongo(self):
-    self.playlists.drop()
+    # Paths, stored or from the source, are read as they're needed
+    self.files = None
+    self.length = playlist_data.get('length', 0)
+    self.generation = playlist_data.get('generation')
+    self.source = playlist_data.get('source')
+    if self.source and self.source.get('type') in RESOLVABLE_SOURCES:
+      self.length = self.source.get('count', 0)
+    self.seed = playlist_data.get('seed')
+    self.set_order()
+    self.window = {}
+    self.current_item = playlist_data.get('current_item')
+    self.current_index = playlist_data.get('current_index', 0)
+    self.current_offset = playlist_data.get('current_offset', 0)
+    self.version = playlist_data.get('version', 0)
 
-    playlist_data = {
-      "urls": self.urls,
+  # Writes only the position in the queue, and only if nobody else has
+  # changed the queue since we read it.
+  def save(self):
+    saved = self.store.update(self.key, self.version, {
       "current_item": self.current_item,
       "current_index": self.current_index,
       "current_offset": self.current_offset
-    }
+    })
+
+    if saved:
+      self.version += 1
+      return True
 
-    self.playlists.insert_one(playlist_data)
+    log.info('Queue was changed by another request, reloading')
+    self.load()
+    return False
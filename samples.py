@@ -0,0 +1,92 @@
+import os
+import re
+import time
+import codecs
+import random
+import logging
+import threading
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds between checks for changes to the sample files
+CHECK_INTERVAL = 10
+
+# don't suggest utterances for the following intents, because they depend on
+# context to make any sense:
+IGNORE_INTENTS = []
+
+_tables = {}
+_lock = threading.Lock()
+
+
+def sample_files(language):
+  return (os.path.join(BASE_DIR, 'sample_slotvals.%s.txt' % (language)),
+          os.path.join(BASE_DIR, 'speech_assets', 'SampleUtterances.%s.txt' % (language)))
+
+
+def modified_times(files):
+  return tuple(os.path.getmtime(fn) for fn in files)
+
+
+# Reads the sample files for a language and substitutes the example slot
+# values into every utterance up front.  Returns a dict of intent to the list
+# of finished utterances.
+def build_table(language):
+  slotvals_file, utterances_file = sample_files(language)
+
+  # read example slot values from language-specific file.
+  sample_slotvals = {}
+  f = codecs.open(slotvals_file, 'rb', 'utf-8')
+  for line in f:
+    media_type, media_title = line.strip().split(' ', 1)
+    sample_slotvals[media_type] = media_title.strip()
+  f.close()
+
+  # build complete list of possible utterances, with the slot references
+  # replaced by sample media titles.
+  utterances = {}
+  f = codecs.open(utterances_file, 'rb', 'utf-8')
+  for line in f:
+    intent, utterance = line.strip().split(' ', 1)
+    if intent in IGNORE_INTENTS: continue
+    utterance = re.sub(r'{(\w+)?}', lambda m: sample_slotvals.get(m.group(1), m.group(1)), utterance)
+    utterances.setdefault(intent.encode('utf-8'), []).append(utterance)
+  f.close()
+
+  return utterances
+
+
+# Returns the table for a language, building it the first time and again
+# whenever one of the sample files has changed.
+def load(language):
+  now = time.time()
+
+  with _lock:
+    table = _tables.get(language)
+    if table and now - table['checked'] < CHECK_INTERVAL:
+      return table
+    files = sample_files(language)
+    mtimes = modified_times(files)
+    if table and table['mtimes'] == mtimes:
+      table['checked'] = now
+      return table
+
+  log.info('Loading help samples for %s', language)
+  utterances = build_table(language)
+  table = {'utterances': utterances, 'intents': utterances.keys(), 'mtimes': mtimes, 'checked': now}
+
+  with _lock:
+    _tables[language] = table
+  return table
+
+
+# pick random utterances to return, up to the specified limit.
+def get_help_samples(language, limit=7):
+  table = load(language)
+
+  sample_utterances = {}
+  for k in random.sample(table['intents'], min(limit, len(table['intents']))):
+    sample_utterances[k] = random.choice(table['utterances'][k])
+  return sample_utterances
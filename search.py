@@ -0,0 +1,148 @@
+import re
+import copy
+import logging
+
+from fuzzywuzzy import utils
+from kodi_voice.kodi import sanitize_name, digits2roman, words2roman, words2digits, digits2words
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+# How many of the closest titles (by shared trigrams) are handed to
+# matchHeard for exact scoring, per variant of the heard string.
+DEFAULT_CANDIDATES = 200
+
+# matchHeard only accepts fuzzy matches scoring 75% or better.  A ratio can't
+# exceed 2 * shorter / (shorter + longer), so titles whose length is too far
+# from the heard string can never match and are skipped.
+MIN_RATIO = 0.745
+
+
+_punctuation_re = re.compile(r'[^\w\s]', re.UNICODE)
+
+
+def simplify_title(s):
+  if isinstance(s, str):
+    s = s.decode('utf-8', 'ignore')
+  return ' '.join(_punctuation_re.sub('', sanitize_name(s.lower())).split())
+
+
+# Whether a title is exactly what was heard, ignoring case, accents and
+# punctuation
+def same_title(title, heard):
+  return simplify_title(title) == simplify_title(heard)
+
+
+def trigrams(s):
+  s = ' %s ' % s
+  return set(s[i:i + 3] for i in range(len(s) - 2))
+
+
+def can_match(heard_len, name_len):
+  if not heard_len or not name_len:
+    return False
+  return 2.0 * min(heard_len, name_len) / (heard_len + name_len) >= MIN_RATIO
+
+
+# Same variants of the heard string that matchHeard tries
+def heard_variants(heard, language):
+  heard_lower = re.sub(r'prozent(?=[.,\s]|$)', '%', heard.lower())
+
+  variants = [heard_lower]
+  for f in (digits2roman, words2roman, words2digits, digits2words):
+    try:
+      variants.append(f(heard_lower, language))
+    except:
+      continue
+  return heard_lower, set(variants)
+
+
+# kodi.matchHeard, converting numbers the way the given language says them
+# rather than the configured language.  Kodi clients are shared between
+# requests in different languages, so the language is set on a copy.
+def match_heard(kodi, heard, items, key='label', limit=10, language=None):
+  if language and language != kodi.language:
+    kodi = copy.copy(kodi)
+    kodi.language = language
+  return kodi.matchHeard(heard, items, key, limit)
+
+
+# Trigram index over the titles of a list of library items.  It narrows the
+# list down to the items that could plausibly match and lets matchHeard do the
+# actual scoring on those, so the result is the same as matchHeard on the full
+# list without scoring every title.
+class SearchIndex:
+  def __init__(self, items, key='label', candidates=DEFAULT_CANDIDATES):
+    self.items = items
+    self.key = key
+    self.candidates = candidates
+
+    # item positions grouped by exact title, so duplicates stay together
+    self.names = []
+    self.positions = []
+    self.lengths = []
+    self.postings = {}
+    self.exact = {}
+
+    name_ids = {}
+    for pos, item in enumerate(items):
+      name = item[key]
+      name_id = name_ids.get(name)
+      if name_id is None:
+        name_id = len(self.names)
+        name_ids[name] = name_id
+        self.names.append(name)
+        self.positions.append([])
+
+        processed = utils.full_process(name, force_ascii=False)
+        self.lengths.append(len(processed))
+        for gram in trigrams(processed):
+          self.postings.setdefault(gram, []).append(name_id)
+
+        name_lower = name.lower()
+        self.exact.setdefault(name_lower, []).append(name_id)
+        name_ascii = sanitize_name(name_lower)
+        if name_ascii != name_lower:
+          self.exact.setdefault(name_ascii, []).append(name_id)
+
+      self.positions[name_id].append(pos)
+
+  def __len__(self):
+    return len(self.items)
+
+  def _items(self, name_ids):
+    positions = []
+    for name_id in name_ids:
+      positions += self.positions[name_id]
+    return [self.items[pos] for pos in sorted(positions)]
+
+  def lookup(self, heard, language='en'):
+    heard_lower, variants = heard_variants(heard, language)
+
+    exact = set(self.exact.get(heard_lower, [])) | set(self.exact.get(sanitize_name(heard_lower), []))
+    if exact:
+      return self._items(exact)
+
+    name_ids = set()
+    for variant in variants:
+      processed = utils.full_process(variant, force_ascii=False)
+      heard_len = len(processed)
+
+      counts = {}
+      for gram in trigrams(processed):
+        for name_id in self.postings.get(gram, ()):
+          counts[name_id] = counts.get(name_id, 0) + 1
+
+      ranked = sorted((n for n in counts if can_match(heard_len, self.lengths[n])), key=lambda n: -counts[n])
+      name_ids.update(ranked[:self.candidates])
+
+    return self._items(name_ids)
+
+  # Drop-in replacement for kodi.matchHeard(heard, items, key, limit), in
+  # the request's language if it's given
+  def match(self, kodi, heard, limit=10, language=None):
+    language = language or kodi.language
+    candidates = self.lookup(heard, language)
+    log.info('Search index narrowed %d items to %d candidates', len(self.items), len(candidates))
+    if not candidates:
+      return []
+    return match_heard(kodi, heard, candidates, self.key, limit, language)
@@ -0,0 +1,67 @@
+import random
+
+ROUNDS = 4
+MASK32 = 0xFFFFFFFF
+
+
+# A shuffled order for size items, defined entirely by the seed.
+#
+# perm[i] is the item to play at position i, and perm.index(item) is the
+# position of an item, both in constant time.  This is a small Feistel network
+# over the next power of four above size, walking the cycle until it lands
+# back inside the range, so it's always a true permutation.
+class Permutation:
+  def __init__(self, size, seed):
+    self.size = size
+    self.seed = seed
+
+    bits = max(2, (max(size, 1) - 1).bit_length())
+    self.half_bits = (bits + 1) // 2
+    self.half_mask = (1 << self.half_bits) - 1
+
+    rnd = random.Random(seed)
+    self.keys = [rnd.getrandbits(32) for _ in range(ROUNDS)]
+
+  def __len__(self):
+    return self.size
+
+  def _round(self, key, x):
+    h = (x * 0x9E3779B1 + key) & MASK32
+    h ^= h >> 15
+    h = (h * 0x85EBCA6B) & MASK32
+    h ^= h >> 13
+    return h & self.half_mask
+
+  def _encrypt(self, x):
+    left, right = x >> self.half_bits, x & self.half_mask
+    for key in self.keys:
+      left, right = right, left ^ self._round(key, right)
+    return (left << self.half_bits) | right
+
+  def _decrypt(self, x):
+    left, right = x >> self.half_bits, x & self.half_mask
+    for key in reversed(self.keys):
+      left, right = right ^ self._round(key, left), left
+    return (left << self.half_bits) | right
+
+  def __getitem__(self, position):
+    if position < 0 or position >= self.size:
+      raise IndexError(position)
+
+    x = self._encrypt(position)
+    while x >= self.size:
+      x = self._encrypt(x)
+    return int(x)
+
+  def index(self, item):
+    if item < 0 or item >= self.size:
+      raise ValueError(item)
+
+    x = self._decrypt(item)
+    while x >= self.size:
+      x = self._decrypt(x)
+    return int(x)
+
+
+def new_seed():
+  return random.getrandbits(31)
@@ -0,0 +1,648 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+import util
+import metrics
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+DEFAULT_MONGO_MAX_POOL_SIZE = 10
+DEFAULT_MONGO_MIN_POOL_SIZE = 0
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'playlist-info.db')
+DEFAULT_MEMORY_SIZE = 1000
+# Longest a position update waits before it's written, with write-behind on
+DEFAULT_FLUSH_DELAY = 1.0
+
+# Queues are split into chunks of this many file paths
+CHUNK_SIZE = 100
+
+# Older SQLite builds allow at most 999 parameters in a statement
+SQLITE_MAX_POSITIONS = 500
+
+QUEUE_FIELDS = ['source', 'seed', 'current_item', 'current_index', 'current_offset', 'length', 'generation', 'version']
+
+# Stores that keep state inside this process must be shared by all requests
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Mongo collections we've already made sure have the queue key index
+_indexed = set()
+
+# Connection reuse counters for the shared Mongo clients.  The pool
+# listener updates them from pymongo's threads.
+_mongo_stats = {
+  'clients_created': 0,
+  'client_reuses': 0,
+  'connections_created': 0,
+  'connections_checked_out': 0,
+}
+_mongo_stats_lock = threading.Lock()
+
+
+def count_mongo(name):
+  with _mongo_stats_lock:
+    _mongo_stats[name] += 1
+
+
+# Queue state storage used by music.MusicPlayer.
+#
+# Queues are identified by a key dict ({"device_id": ..., "user_id": ...}).
+# Every queue has a version that goes up on each write, so that position
+# updates can be made conditional on nobody else having written first.
+#
+# The file paths are kept apart from the position in the queue, so that
+# playback events only read the few paths they need however long the queue
+# is.  Each new queue gets a new generation, and paths are only returned for
+# the generation that was asked for.
+class QueueStore:
+  # Returns the queue without its file paths, or None if there isn't one
+  def load(self, key):
+    raise NotImplementedError
+
+  # Returns a dict of position to file path for the given positions.
+  # Positions outside the queue are left out.
+  def files(self, key, generation, positions):
+    raise NotImplementedError
+
+  # Writes a whole new queue, including state['files'], and returns its version
+  def create(self, key, state):
+    raise NotImplementedError
+
+  # Applies fields if the stored version still matches, and moves the version
+  # on by steps.  Returns True if it did.
+  def update(self, key, version, fields, steps=1):
+    raise NotImplementedError
+
+  # Adds files to the end of the queue if the stored version still matches
+  def extend(self, key, version, files):
+    raise NotImplementedError
+
+
+def new_generation():
+  import uuid
+  return uuid.uuid4().hex
+
+
+# Splits positions first..first+len(files) into (chunk number, files) pairs
+def chunked(first, files):
+  chunks = []
+  while files:
+    chunk, offset = divmod(first, CHUNK_SIZE)
+    part = files[:CHUNK_SIZE - offset]
+    chunks.append((chunk, part))
+    first += len(part)
+    files = files[len(part):]
+  return chunks
+
+
+def make_connection_listener():
+  try:
+    from pymongo.monitoring import ConnectionPoolListener
+  except ImportError:
+    # pymongo < 3.9 can't tell us about individual connections
+    return None
+
+  class ConnectionCounter(ConnectionPoolListener):
+    def connection_created(self, event):
+      count_mongo('connections_created')
+
+    def connection_checked_out(self, event):
+      count_mongo('connections_checked_out')
+
+    def pool_created(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+  return ConnectionCounter()
+
+
+def mongo_stats():
+  with _mongo_stats_lock:
+    stats = dict(_mongo_stats)
+  if stats['connections_checked_out']:
+    stats['connection_reuse_ratio'] = 1 - float(stats['connections_created']) / stats['connections_checked_out']
+  return stats
+
+metrics.register(metrics.Stats('koko_mongo', 'MongoDB client and connection reuse in this process.', mongo_stats,
+                               counters=tuple(_mongo_stats)))
+
+
+# The position in the queue is kept in the playlist-info collection and the
+# file paths in playlist-chunks, CHUNK_SIZE to a document, so neither gets
+# near Mongo's document size limit.
+class MongoStore(QueueStore):
+  # The client is created lazily (connect=False) and only ever used by the
+  # process that created it, so it's safe to have one before gunicorn forks.
+  def __init__(self, uri, max_pool_size=DEFAULT_MONGO_MAX_POOL_SIZE, min_pool_size=DEFAULT_MONGO_MIN_POOL_SIZE):
+    from pymongo import MongoClient, ASCENDING
+
+    kwargs = {'maxPoolSize': max_pool_size, 'minPoolSize': min_pool_size, 'connect': False}
+    listener = make_connection_listener()
+    if listener:
+      kwargs['event_listeners'] = [listener]
+
+    log.info('Creating MongoDB client for process %d', os.getpid())
+    self.client = MongoClient(uri, **kwargs)
+    count_mongo('clients_created')
+
+    database_name = uri.rsplit('/', 1)[1]
+    self.playlists = self.client[database_name]['playlist-info']
+    self.chunks = self.client[database_name]['playlist-chunks']
+
+    if uri not in _indexed:
+      self.playlists.create_index([("device_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+      self.chunks.create_index([("device_id", ASCENDING), ("user_id", ASCENDING),
+                                ("generation", ASCENDING), ("chunk", ASCENDING)], unique=True)
+      _indexed.add(uri)
+
+  def load(self, key):
+    # Queues saved before the paths were chunked kept them in this document
+    return self.playlists.find_one(key, projection={"files": False})
+
+  def files(self, key, generation, positions):
+    wanted = set(p // CHUNK_SIZE for p in positions if p >= 0)
+    query = dict(key, generation=generation, chunk={"$in": sorted(wanted)})
+
+    by_chunk = {}
+    for chunk in self.chunks.find(query, projection={"_id": False, "chunk": True, "files": True}):
+      by_chunk[chunk['chunk']] = chunk['files']
+
+    found = {}
+    for p in positions:
+      chunk, offset = divmod(p, CHUNK_SIZE)
+      if p >= 0 and offset < len(by_chunk.get(chunk, [])):
+        found[p] = by_chunk[chunk][offset]
+    return found
+
+  # The chunks are written before the queue points at them, so readers
+  # never see a generation that isn't there yet.  Only the generation this
+  # create replaced is deleted afterwards; another create for the same queue
+  # may be writing chunks for a newer one at the same time.
+  def create(self, key, state):
+    from pymongo import ReturnDocument
+
+    state = dict(state)
+    files = state.pop('files')
+    state['length'] = len(files)
+    state['generation'] = new_generation()
+
+    documents = [dict(key, generation=state['generation'], chunk=chunk, files=part) for chunk, part in chunked(0, files)]
+    if documents:
+      self.chunks.insert_many(documents)
+
+    previous = self.playlists.find_one_and_update(
+      key,
+      {"$set": state, "$unset": {"files": ""}, "$inc": {"version": 1}},
+      projection={"version": True, "generation": True},
+      upsert=True,
+      return_document=ReturnDocument.BEFORE
+    )
+
+    if not previous:
+      return 1
+    if previous.get('generation'):
+      self.chunks.delete_many(dict(key, generation=previous['generation']))
+    return previous.get('version', 0) + 1
+
+  def update(self, key, version, fields, steps=1):
+    query = dict(key, version=version)
+    result = self.playlists.update_one(query, {"$set": fields, "$inc": {"version": steps}})
+    return result.matched_count > 0
+
+  def extend(self, key, version, files):
+    from pymongo import ReturnDocument
+
+    query = dict(key, version=version)
+    playlist_data = self.playlists.find_one_and_update(
+      query,
+      {"$inc": {"version": 1, "length": len(files)}},
+      projection={"length": True, "generation": True},
+      return_document=ReturnDocument.BEFORE
+    )
+    if not playlist_data:
+      return False
+
+    for chunk, part in chunked(playlist_data['length'], files):
+      self.chunks.update_one(dict(key, generation=playlist_data['generation'], chunk=chunk),
+                             {"$push": {"files": {"$each": part}}}, upsert=True)
+    return True
+
+
+# Single file database for deployments without a Mongo server.  WAL mode lets
+# readers carry on while a playback event is being written.  File paths are
+# stored one row per track in playlist_files.
+class SQLiteStore(QueueStore):
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local()
+
+    db = self._db()
+    db.execute("PRAGMA journal_mode=WAL")
+
+    # Queues saved before file paths were split out can't be carried over
+    columns = [row[1] for row in db.execute("PRAGMA table_info(playlist_info)")]
+    if columns and 'generation' not in columns:
+      log.info('Dropping queues saved by an older version')
+      db.execute("DROP TABLE playlist_info")
+
+    db.execute("""
+      CREATE TABLE IF NOT EXISTS playlist_info (
+        device_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        source TEXT,
+        seed INTEGER,
+        current_item TEXT,
+        current_index INTEGER NOT NULL,
+        current_offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        generation TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (device_id, user_id)
+      )""")
+    db.execute("""
+      CREATE TABLE IF NOT EXISTS playlist_files (
+        device_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        generation TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        file TEXT NOT NULL,
+        PRIMARY KEY (device_id, user_id, generation, position)
+      )""")
+
+  # sqlite3 connections can't be shared between threads
+  def _db(self):
+    db = getattr(self.local, 'db', None)
+    if db is None:
+      import sqlite3
+      db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+      db.execute("PRAGMA synchronous=NORMAL")
+      self.local.db = db
+    return db
+
+  def _key(self, key):
+    return (key['device_id'], key['user_id'] or '')
+
+  def load(self, key):
+    row = self._db().execute(
+      "SELECT %s FROM playlist_info WHERE device_id = ? AND user_id = ?" % ', '.join(QUEUE_FIELDS),
+      self._key(key)).fetchone()
+    if not row:
+      return None
+
+    playlist_data = dict(zip(QUEUE_FIELDS, row))
+    playlist_data['source'] = json.loads(playlist_data['source'] or 'null')
+    return playlist_data
+
+  def files(self, key, generation, positions):
+    positions = list(positions)
+    found = {}
+    for i in range(0, len(positions), SQLITE_MAX_POSITIONS):
+      part = positions[i:i + SQLITE_MAX_POSITIONS]
+      found.update(self._db().execute(
+        "SELECT position, file FROM playlist_files WHERE device_id = ? AND user_id = ? AND generation = ? "
+        "AND position IN (%s)" % ', '.join('?' * len(part)),
+        list(self._key(key)) + [generation] + part))
+    return found
+
+  def _insert_files(self, db, device_id, user_id, generation, first, files):
+    db.executemany(
+      "INSERT INTO playlist_files (device_id, user_id, generation, position, file) VALUES (?, ?, ?, ?, ?)",
+      [(device_id, user_id, generation, first + i, f) for i, f in enumerate(files)])
+
+  def create(self, key, state):
+    db = self._db()
+    device_id, user_id = self._key(key)
+    generation = new_generation()
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      row = db.execute("SELECT version FROM playlist_info WHERE device_id = ? AND user_id = ?",
+                       (device_id, user_id)).fetchone()
+      version = (row[0] if row else 0) + 1
+      db.execute(
+        "INSERT OR REPLACE INTO playlist_info "
+        "(device_id, user_id, source, seed, current_item, current_index, current_offset, length, generation, version) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (device_id, user_id, json.dumps(state.get('source')), state.get('seed'), state['current_item'],
+         state['current_index'], state['current_offset'], len(state['files']), generation, version))
+      db.execute("DELETE FROM playlist_files WHERE device_id = ? AND user_id = ?", (device_id, user_id))
+      self._insert_files(db, device_id, user_id, generation, 0, state['files'])
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+    return version
+
+  def update(self, key, version, fields, steps=1):
+    columns = sorted(fields.keys())
+    assignments = ', '.join('%s = ?' % c for c in columns)
+    params = [fields[c] for c in columns] + [steps] + list(self._key(key)) + [version]
+
+    cursor = self._db().execute(
+      "UPDATE playlist_info SET %s, version = version + ? "
+      "WHERE device_id = ? AND user_id = ? AND version = ?" % assignments, params)
+    return cursor.rowcount > 0
+
+  def extend(self, key, version, files):
+    db = self._db()
+    device_id, user_id = self._key(key)
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      row = db.execute("SELECT length, generation FROM playlist_info WHERE device_id = ? AND user_id = ? AND version = ?",
+                       (device_id, user_id, version)).fetchone()
+      if row:
+        db.execute("UPDATE playlist_info SET length = length + ?, version = version + 1 WHERE device_id = ? AND user_id = ?",
+                   (len(files), device_id, user_id))
+        self._insert_files(db, device_id, user_id, row[1], row[0], files)
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+    return row is not None
+
+
+# Keeps the most recently used queues in this process only.  Useful for tests
+# and single process setups; queues don't survive a restart and aren't shared
+# between gunicorn workers.
+class MemoryStore(QueueStore):
+  def __init__(self, size=DEFAULT_MEMORY_SIZE):
+    self.size = size
+    self.queues = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _key(self, key):
+    return (key['device_id'], key['user_id'])
+
+  def load(self, key):
+    with self.lock:
+      playlist_data = self.queues.pop(self._key(key), None)
+      if playlist_data is None:
+        return None
+      self.queues[self._key(key)] = playlist_data
+
+      playlist_data = dict(playlist_data)
+      del playlist_data['files']
+      return playlist_data
+
+  def files(self, key, generation, positions):
+    with self.lock:
+      playlist_data = self.queues.get(self._key(key))
+      if not playlist_data or playlist_data['generation'] != generation:
+        return {}
+
+      files = playlist_data['files']
+      return dict((p, files[p]) for p in positions if 0 <= p < len(files))
+
+  def create(self, key, state):
+    with self.lock:
+      old = self.queues.pop(self._key(key), None)
+      playlist_data = dict(state, length=len(state['files']), generation=new_generation(),
+                           version=(old['version'] if old else 0) + 1)
+      self.queues[self._key(key)] = playlist_data
+
+      while len(self.queues) > self.size:
+        self.queues.popitem(last=False)
+      return playlist_data['version']
+
+  def update(self, key, version, fields, steps=1):
+    with self.lock:
+      playlist_data = self.queues.get(self._key(key))
+      if not playlist_data or playlist_data['version'] != version:
+        return False
+
+      playlist_data.update(fields)
+      playlist_data['version'] += steps
+      return True
+
+  def extend(self, key, version, files):
+    with self.lock:
+      playlist_data = self.queues.get(self._key(key))
+      if not playlist_data or playlist_data['version'] != version:
+        return False
+
+      playlist_data['files'] = playlist_data['files'] + files
+      playlist_data['length'] = len(playlist_data['files'])
+      playlist_data['version'] += 1
+      return True
+
+
+# Wraps a QueueStore so that position updates are answered straight away and
+# written a little later.  Updates to the same queue made before the write
+# are merged into one, and the version moves on by the number of updates
+# merged, so versions are the same whether or not an update was held back.
+#
+# Loads in this process see held-back updates, so a request always sees the
+# last position written by this worker, and an update from a version this
+# worker already knows is out of date fails straight away.  An update that
+# another process beat to the store is dropped when it's written, as it would
+# have been had it been written straight away.  New queues and party mode
+# top-ups are written straight through, after any update held back for the
+# queue.
+#
+# Held-back updates are written at exit, but a process that is killed or
+# frozen (as on Lambda) can lose the last second or so of positions.
+class WriteBehindStore:
+  def __init__(self, store, delay=DEFAULT_FLUSH_DELAY, size=DEFAULT_MEMORY_SIZE):
+    self.store = store
+    self.delay = delay
+    self.size = size
+    # key -> {'key', 'base', 'version', 'fields', 'due'}
+    self.pending = {}
+    # Updates being written right now, still visible to loads
+    self.flushing = {}
+    # The version of each recently used queue as this process last saw it
+    self.versions = OrderedDict()
+    self.lock = threading.Condition()
+    self.stats = {'updates': 0, 'writes': 0, 'conflicts': 0, 'errors': 0}
+
+    self.stopping = False
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self.close)
+
+  def __getattr__(self, name):
+    return getattr(self.store, name)
+
+  def _key(self, key):
+    return (key['device_id'], key['user_id'])
+
+  # Call with the lock held
+  def _seen(self, k, version):
+    self.versions.pop(k, None)
+    if version is not None:
+      self.versions[k] = version
+      while len(self.versions) > self.size:
+        self.versions.popitem(last=False)
+
+  def load(self, key):
+    k = self._key(key)
+    with self.lock:
+      held = [p for p in (self.flushing.get(k), self.pending.get(k)) if p]
+    playlist_data = self.store.load(key)
+
+    with self.lock:
+      for p in held:
+        if playlist_data and playlist_data.get('version') == p['base']:
+          playlist_data = dict(playlist_data, **p['fields'])
+          playlist_data['version'] = p['version']
+        elif self.pending.get(k) is p:
+          # Another process changed the queue, so this could never be written
+          log.info('Queue was changed by another process, dropping position update')
+          del self.pending[k]
+          self.stats['conflicts'] += 1
+      self._seen(k, playlist_data.get('version') if playlist_data else None)
+    return playlist_data
+
+  def update(self, key, version, fields, steps=1):
+    k = self._key(key)
+    with self.lock:
+      if self.versions.get(k, version) != version:
+        return False
+
+      p = self.pending.get(k)
+      if not p:
+        p = {'key': key, 'base': version, 'version': version, 'fields': {}, 'due': time.time() + self.delay}
+        self.pending[k] = p
+        self.lock.notify()
+
+      p['fields'].update(fields)
+      p['version'] += steps
+      self._seen(k, p['version'])
+      self.stats['updates'] += 1
+      return True
+
+  def create(self, key, state):
+    self.flush(key)
+    version = self.store.create(key, state)
+    with self.lock:
+      self._seen(self._key(key), version)
+    return version
+
+  def extend(self, key, version, files):
+    self.flush(key)
+    extended = self.store.extend(key, version, files)
+    with self.lock:
+      self._seen(self._key(key), version + 1 if extended else None)
+    return extended
+
+  # Writes the held-back update for one queue, if there is one
+  def flush(self, key):
+    k = self._key(key)
+    with self.lock:
+      p = self.pending.pop(k, None)
+      if p:
+        self.flushing[k] = p
+    if p:
+      self.write(k, p)
+
+  def write(self, k, p):
+    try:
+      if self.store.update(p['key'], p['base'], p['fields'], p['version'] - p['base']):
+        outcome = 'writes'
+      else:
+        log.info('Queue was changed by another process, dropping position update')
+        outcome = 'conflicts'
+    except:
+      log.exception('Unable to write position update')
+      outcome = 'errors'
+
+    with self.lock:
+      self.stats[outcome] += 1
+      if self.flushing.get(k) is p:
+        del self.flushing[k]
+      if outcome != 'writes' and k not in self.pending:
+        self._seen(k, None)
+
+  def flush_all(self):
+    with self.lock:
+      keys = [p['key'] for p in self.pending.values()]
+    for key in keys:
+      self.flush(key)
+
+  # Stops the writer thread and writes whatever is still held back
+  def close(self):
+    with self.lock:
+      self.stopping = True
+      self.lock.notify()
+    self.thread.join(5)
+    self.flush_all()
+
+  def run(self):
+    while True:
+      with self.lock:
+        if self.stopping:
+          return
+        now = time.time()
+        due = [p['key'] for p in self.pending.values() if p['due'] <= now]
+        if not due:
+          wait = min([p['due'] for p in self.pending.values()] or [now + 60]) - now
+          self.lock.wait(max(wait, 0.01))
+          continue
+
+      for key in due:
+        self.flush(key)
+
+
+# queue_backend can be mongo (the default), sqlite or memory
+def backend_name(kodi):
+  return util.get_option(kodi, 'queue_backend', 'mongo').lower()
+
+
+def is_configured(kodi):
+  backend = backend_name(kodi)
+
+  if backend == 'mongo':
+    try:
+      import pymongo
+    except:
+      return False
+    return bool(util.get_option(kodi, 'mongodb_uri'))
+
+  return backend in ('sqlite', 'memory')
+
+
+def get_store(kodi):
+  backend = backend_name(kodi)
+
+  if backend == 'sqlite':
+    key = ('sqlite', util.get_option(kodi, 'queue_sqlite_path', DEFAULT_SQLITE_PATH))
+    factory = lambda: SQLiteStore(key[1])
+  elif backend == 'memory':
+    key = ('memory', None)
+    factory = lambda: MemoryStore(util.get_int_option(kodi, 'queue_memory_size', DEFAULT_MEMORY_SIZE))
+  else:
+    # Clients can't be carried across a fork, so each worker gets its own
+    key = ('mongo', util.get_option(kodi, 'mongodb_uri'), os.getpid())
+    factory = lambda: MongoStore(key[1],
+                                 util.get_int_option(kodi, 'mongodb_max_pool_size', DEFAULT_MONGO_MAX_POOL_SIZE),
+                                 util.get_int_option(kodi, 'mongodb_min_pool_size', DEFAULT_MONGO_MIN_POOL_SIZE))
+
+  # Not for Lambda, which freezes the process as soon as it has answered
+  write_behind = util.get_bool_option(kodi, 'queue_write_behind')
+  key += (write_behind,)
+
+  with _stores_lock:
+    store = _stores.get(key)
+    if not store:
+      log.info('Using %s queue storage%s', backend, ' with write-behind' if write_behind else '')
+      store = factory()
+      if metrics.enabled:
+        store = metrics.TimedStore(store, backend)
+      if write_behind:
+        store = WriteBehindStore(store, util.get_float_option(kodi, 'queue_flush_delay', DEFAULT_FLUSH_DELAY))
+      _stores[key] = store
+    elif backend == 'mongo':
+      count_mongo('client_reuses')
+  return store
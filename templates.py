@@ -0,0 +1,107 @@
+import os
+import logging
+import threading
+
+import yaml
+from jinja2 import BaseLoader, TemplateNotFound, meta
+
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader
+
+log = logging.getLogger('kodi_alexa.' + __name__)
+
+# Languages there are templates.<language>.yaml files for
+LANGUAGES = ('en', 'de', 'it')
+
+
+# Response templates from a templates.<language>.yaml file, for a jinja
+# environment.  The file is parsed on first use, with libyaml when it's
+# available, and then kept for the life of the process.  flask-ask's own
+# loader parses it with the pure Python parser at startup and checks the
+# file for changes on every response.
+class FrozenYamlLoader(BaseLoader):
+  def __init__(self, path):
+    self.path = path
+    self.mapping = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    with self.lock:
+      if self.mapping is None:
+        log.info('Loading response templates from %s', self.path)
+        with open(self.path) as f:
+          self.mapping = yaml.load(f, Loader=SafeLoader) or {}
+    return self.mapping
+
+  def get_source(self, environment, template):
+    mapping = self.mapping if self.mapping is not None else self.load()
+    if template not in mapping:
+      raise TemplateNotFound(template)
+    return mapping[template], None, lambda: True
+
+  def list_templates(self):
+    return sorted(self.load().keys())
+
+
+def template_files(root):
+  return dict((language, os.path.join(root, 'templates.%s.yaml' % (language))) for language in LANGUAGES)
+
+
+# The language to answer in for a request locale such as "de-DE"
+def language_for_locale(locale, default):
+  language = (locale or '').split('-')[0].lower()
+  return language if language in LANGUAGES else default
+
+
+# Serves every language's templates to one jinja environment, named
+# "<language>/<template>"
+class CatalogLoader(BaseLoader):
+  def __init__(self, paths):
+    self.catalogs = dict((language, FrozenYamlLoader(path)) for language, path in paths.iteritems())
+
+  def get_source(self, environment, template):
+    language, _, name = template.partition('/')
+    if language not in self.catalogs:
+      raise TemplateNotFound(template)
+    return self.catalogs[language].get_source(environment, name)
+
+  def list_templates(self):
+    return ['%s/%s' % (language, name) for language in sorted(self.catalogs)
+            for name in self.catalogs[language].list_templates()]
+
+
+# Compiled templates for every language, kept for the life of the process.
+# Templates that don't use any values are rendered once when they're
+# compiled, and the text reused after that.
+class Catalogs:
+  def __init__(self, environment):
+    self.environment = environment
+    self.compiled = {}
+    self.static = {}
+    self.lock = threading.Lock()
+
+  def compile(self, name):
+    with self.lock:
+      if name not in self.compiled:
+        source = self.environment.loader.get_source(self.environment, name)[0]
+        template = self.environment.get_template(name)
+        if not meta.find_undeclared_variables(self.environment.parse(source)):
+          self.static[name] = template.render()
+        self.compiled[name] = template
+    return self.compiled[name]
+
+  # Parses and compiles every language's templates up front
+  def compile_all(self):
+    for name in self.environment.loader.list_templates():
+      self.compile(name)
+    log.info('Compiled %d response templates, %d of them static', len(self.compiled), len(self.static))
+
+  def render(self, language, name, **context):
+    name = '%s/%s' % (language, name)
+    if name not in self.compiled:
+      self.compile(name)
+    if name in self.static:
+      return self.static[name]
+    return self.compiled[name].render(**context)
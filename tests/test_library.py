@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+from kodi_voice import KodiConfigParser, Kodi
+
+import library
+import deadline
+
+
+ARTISTS = [{'artistid': 1, 'artist': 'Sia'}, {'artistid': 2, 'artist': 'Sigur Ros'}]
+
+
+# A Kodi client whose library answers come from a dict of category to
+# items, or that fails while library is None
+def kodi_with(library_items):
+  kodi = Kodi(KodiConfigParser(os.path.join(REPO_DIR, 'nonexistent.config')))
+
+  def send_command(command, wait_resp=True, cache_resp=False):
+    if kodi.library_items is None:
+      raise IOError('Kodi is down')
+    category = [c for c in library.CATEGORIES if library.CATEGORIES[c][0] in command][0]
+    return {'result': {category: kodi.library_items.get(category, [])}}
+
+  kodi.library_items = library_items
+  kodi.SendCommand = send_command
+  return kodi
+
+
+class UnavailableLibraryTest(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = library.LibrarySnapshot(ttl=60)
+
+  def find_artist(self, kodi, heard):
+    music_library = library.Library(kodi)
+    music_library.snapshot = self.snapshot
+    return music_library.find_artist(heard)
+
+  # A failed fetch isn't reported as "not found", and isn't remembered
+  def test_failed_fetch_is_not_a_miss(self):
+    kodi = kodi_with(None)
+    self.assertRaises(library.LibraryUnavailable, self.find_artist, kodi, 'sia')
+
+    kodi.library_items = {'artists': ARTISTS}
+    self.assertEqual([a['artistid'] for a in self.find_artist(kodi, 'sia')], [1])
+
+  def test_miss_in_empty_library_is_not_remembered(self):
+    kodi = kodi_with({'artists': []})
+    self.assertEqual(self.find_artist(kodi, 'sia'), [])
+    self.assertEqual(self.snapshot.resolutions.stats()['entries'], 0)
+
+  def test_failed_refresh_keeps_earlier_copy(self):
+    kodi = kodi_with({'artists': ARTISTS})
+    self.find_artist(kodi, 'sia')
+
+    kodi.library_items = None
+    self.assertEqual(len(self.snapshot.refresh(kodi, 'artists')['items']), 2)
+
+
+class ArtistAlbumsTest(unittest.TestCase):
+  def setUp(self):
+    kodi = kodi_with({
+      'albums': [
+        {'albumid': 1, 'label': 'Some People Have Real Problems', 'artistid': [1]},
+        {'albumid': 2, 'label': 'Now 90', 'artistid': [3]},
+        {'albumid': 3, 'label': 'Takk', 'artistid': [2]},
+      ],
+      'songs': [
+        {'songid': 1, 'label': 'Breathe Me', 'albumid': 1, 'artistid': [1], 'albumartistid': [1]},
+        {'songid': 2, 'label': 'Titanium', 'albumid': 2, 'artistid': [4, 1], 'albumartistid': [3]},
+        {'songid': 3, 'label': 'Glosoli', 'albumid': 3, 'artistid': [2], 'albumartistid': [2]},
+      ],
+    })
+    self.music_library = library.Library(kodi)
+    self.music_library.snapshot = library.LibrarySnapshot(ttl=60)
+
+  # Albums with songs by the artist count, as they do for Kodi's filter
+  def test_compilations_included(self):
+    self.assertEqual([a['albumid'] for a in self.music_library.artist_albums(1)], [1, 2])
+    self.assertEqual([a['albumid'] for a in self.music_library.artist_albums(2)], [3])
+
+  def test_find_compilation(self):
+    located = self.music_library.find_artist_album(1, 'now 90')
+    self.assertEqual([a['albumid'] for a in located][:1], [2])
+
+
+class PrefetchTest(unittest.TestCase):
+  def setUp(self):
+    self.kodi = kodi_with({'artists': ARTISTS})
+    self.snapshot = library.LibrarySnapshot(ttl=60)
+    self.lock = threading.Lock()
+    self.in_flight = 0
+    self.most_in_flight = 0
+
+    send_command = self.kodi.SendCommand
+    def slow_send_command(command, wait_resp=True, cache_resp=False):
+      with self.lock:
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+      time.sleep(0.1)
+      with self.lock:
+        self.in_flight -= 1
+      return send_command(command, wait_resp, cache_resp)
+    self.kodi.SendCommand = slow_send_command
+
+  def get_all(self):
+    self.snapshot.prefetch(self.kodi, ['albums', 'songs'])
+    return [len(self.snapshot.get(self.kodi, c)['items']) for c in ('artists', 'albums', 'songs')]
+
+  def test_fetched_together(self):
+    self.assertEqual(self.get_all(), [2, 0, 0])
+    self.assertEqual(self.most_in_flight, 3)
+
+  def test_fetched_together_under_deadline(self):
+    with deadline.Budget(5):
+      self.assertEqual(self.get_all(), [2, 0, 0])
+    self.assertEqual(self.most_in_flight, 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
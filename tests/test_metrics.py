@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+from ConfigParser import SafeConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from flask_ask import Ask
+
+import metrics
+
+
+def metrics_app():
+  app = Flask(__name__)
+  Ask(app, '/', None, path='')
+
+  config = SafeConfigParser()
+  config.add_section('global')
+  config.set('global', 'metrics_enabled', 'yes')
+  metrics.setup(app, config)
+  return app
+
+
+class PlainRequestTest(unittest.TestCase):
+  # Requests that aren't from Alexa still get their own response, and are
+  # counted as unknown
+  def test_plain_get_with_metrics_on(self):
+    client = metrics_app().test_client()
+
+    self.assertEqual(client.get('/').status_code, 405)
+    self.assertEqual(client.get('/nope').status_code, 404)
+
+    response = client.get('/metrics')
+    self.assertEqual(response.status_code, 200)
+    self.assertIn('koko_intent_seconds_count{intent="unknown"} 2', response.data)
+
+
+class StatsTest(unittest.TestCase):
+  def test_render(self):
+    stats = metrics.Stats('koko_test', 'Test counters.', lambda: {'created': 3, 'ratio': 0.5}, counters=('created',))
+    lines = stats.render()
+
+    self.assertIn('# TYPE koko_test_created_total counter', lines)
+    self.assertIn('koko_test_created_total 3', lines)
+    self.assertIn('# TYPE koko_test_ratio gauge', lines)
+    self.assertIn('koko_test_ratio 0.5', lines)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import random
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from kodi_voice import KodiConfigParser, Kodi
+
+import search
+import library
+import synthetic
+
+
+def english_kodi():
+  config = KodiConfigParser(os.path.join(REPO_DIR, 'nonexistent.config'))
+  config.set('global', 'language', 'en')
+  return Kodi(config)
+
+
+ALBUMS = [
+  {'albumid': 1, 'label': '7 Tage', 'artistid': [1]},
+  {'albumid': 2, 'label': 'Abendrot', 'artistid': [1]},
+  {'albumid': 3, 'label': 'Morgenstern', 'artistid': [2]},
+]
+
+
+class LanguageMatchTest(unittest.TestCase):
+  def setUp(self):
+    self.kodi = english_kodi()
+    self.index = search.SearchIndex(ALBUMS)
+
+  # A deployment configured for English still hears German numbers from a
+  # de-DE device
+  def test_german_numbers(self):
+    located = self.index.match(self.kodi, 'sieben tage', language='de')
+    self.assertEqual([a['albumid'] for a in located][:1], [1])
+    self.assertEqual(self.kodi.language, 'en')
+
+  def test_configured_language_by_default(self):
+    self.assertEqual(self.index.match(self.kodi, 'sieben tage'), [])
+
+  def test_library_caches_each_language_apart(self):
+    snapshot = library.LibrarySnapshot(ttl=60)
+    snapshot._entries['albums'] = library.build_entry('albums', ALBUMS)
+    key = (self.kodi.scheme, self.kodi.address, self.kodi.port, self.kodi.subpath)
+    library._snapshots[key] = snapshot
+    self.addCleanup(library._snapshots.pop, key)
+
+    self.assertEqual(library.Library(self.kodi, 'en').find_album('sieben tage'), [])
+    located = library.Library(self.kodi, 'de').find_album('sieben tage')
+    self.assertEqual([a['albumid'] for a in located][:1], [1])
+
+
+# The index only narrows down what kodi.matchHeard() looks at, so it should
+# give the same matches
+class ParityTest(unittest.TestCase):
+  def setUp(self):
+    self.kodi = english_kodi()
+    self.library = synthetic.library(2000)
+
+  def check(self, items, key):
+    index = search.SearchIndex(items, key)
+    rnd = random.Random(2)
+    for _ in range(30):
+      heard = synthetic.heard(rnd, rnd.choice(items)[key])
+      self.assertEqual(index.match(self.kodi, heard), self.kodi.matchHeard(heard, items, key), heard)
+
+  def test_artists(self):
+    self.check(self.library[0], 'artist')
+
+  def test_albums(self):
+    self.check(self.library[1], 'label')
+
+  def test_songs(self):
+    self.check(self.library[2], 'label')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+import os
+
+accepted_answers = ['y', 'yes', 'Y', 'Yes', 'YES', 'true', 'True']
+
+
+# Read an optional skill setting.  Looks in the device's section of kodi.config
+# first (which falls back to [DEFAULT]), then in an environment variable of the
+# same name in upper case for Heroku/Lambda deployments, then uses the default.
+def get_option(kodi, option, default=None, section=None):
+  if not section:
+    section = kodi.dev_cfg_section
+
+  try:
+    value = kodi.config.get(section, option)
+  except:
+    value = None
+
+  if not value or value == 'None':
+    value = os.getenv(option.upper())
+
+  if not value or value == 'None':
+    return default
+  return value
+
+
+def get_int_option(kodi, option, default=None, section=None):
+  try:
+    return int(get_option(kodi, option, default, section))
+  except (TypeError, ValueError):
+    return default
+
+
+def get_float_option(kodi, option, default=None, section=None):
+  try:
+    return float(get_option(kodi, option, default, section))
+  except (TypeError, ValueError):
+    return default
+
+
+def get_bool_option(kodi, option, default=False, section=None):
+  value = get_option(kodi, option, None, section)
+  if value is None:
+    return default
+  return value in accepted_answers